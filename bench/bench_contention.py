@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Benchmark DynamicPoolResizer.run() called by many threads at once, as
+done by applications that resize their pool from the request threads
+instead of running a PoolMonitor.
+
+It compares the default blocking run(), where every call waits for the
+previous ones and repeats the decision, with the non-blocking runs
+enabled by the mininterval parameter.
+
+Usage: python bench/bench_contention.py [threads] [seconds]
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dynpool
+
+
+class StaticPool(object):
+    """Pool that never changes, so runs only cost the decision."""
+    size, idle, qsize, min, max = 10, 6, 0, 2, 50
+
+    def grow(self, amount):
+        pass
+
+    def shrink(self, amount):
+        pass
+
+
+def hammer(resizer, threads, seconds):
+    calls = [0] * threads
+    start = threading.Event()
+    stop = [False]
+
+    def caller(index):
+        run = resizer.run
+        count = 0
+        start.wait()
+        while not stop[0]:
+            run()
+            count += 1
+        calls[index] = count
+
+    workers = [threading.Thread(target=caller, args=(index,))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    started = time.time()
+    start.set()
+    time.sleep(seconds)
+    stop[0] = True
+    for worker in workers:
+        worker.join()
+    return sum(calls), time.time() - started
+
+
+def main(threads, seconds):
+    print('{0:<16} {1:>10} {2:>12} {3:>8}'.format(
+        'mode', 'calls', 'us/call', 'runs'))
+    for name, mininterval in [('blocking', None), ('skip-concurrent', 0),
+                              ('interval-10ms', 0.01), ('interval-1s', 1)]:
+        metrics = dynpool.ResizerMetrics()
+        resizer = dynpool.DynamicPoolResizer(
+            StaticPool(), minspare=5, maxspare=10, metrics=metrics,
+            mininterval=mininterval)
+        calls, elapsed = hammer(resizer, threads, seconds)
+        print('{0:<16} {1:>10} {2:>12.2f} {3:>8}'.format(
+            name, calls, elapsed * threads / calls * 1e6, metrics.runs))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 2)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Benchmark the reference pools of dynpool driven by a
+DynamicPoolResizer.
+
+For every pool it measures the cost of reading the pool state, as done
+once per run() by the resizer, and the time to handle a burst of short
+jobs while a PoolMonitor resizes the pool.
+
+Usage: python bench/bench_pools.py [jobs]
+"""
+
+import os
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dynpool
+
+
+def job(seconds):
+    time.sleep(seconds)
+
+
+def burst(pool, submit, jobs, done):
+    resizer = dynpool.DynamicPoolResizer(pool, minspare=2, maxspare=8,
+                                         shrinkfreq=1)
+    monitor = dynpool.PoolMonitor(resizer, interval=0.1)
+    monitor.start()
+    try:
+        started = time.time()
+        for _ in range(jobs):
+            submit()
+        while not done():
+            time.sleep(0.001)
+        elapsed = time.time() - started
+    finally:
+        monitor.stop()
+    return elapsed, resizer
+
+
+def report(name, pool, elapsed, resizer):
+    snapshot = timeit.timeit(resizer.take_snapshot, number=10000) / 10000
+    print('{0:<10} snapshot {1:8.2f}us  burst {2:6.2f}s  size {3:>3}'
+          ' churn {4}'.format(name, snapshot * 1e6, elapsed, pool.size,
+                              resizer.churn))
+
+
+def main(jobs):
+    pool = dynpool.ThreadPool(min=2, max=64)
+    elapsed, resizer = burst(
+        pool, lambda: pool.submit(job, 0.01), jobs,
+        lambda: pool.qsize == 0 and pool.idle == pool.size)
+    report('threads', pool, elapsed, resizer)
+    pool.shutdown()
+
+    pool = dynpool.ProcessPool(min=2, max=16)
+    elapsed, resizer = burst(
+        pool, lambda: pool.submit(job, 0.01), jobs,
+        lambda: pool.qsize == 0 and pool.idle == pool.size)
+    report('processes', pool, elapsed, resizer)
+    pool.shutdown()
+
+    pool = dynpool.ResourcePool(object, min=2, max=64)
+    pending = [jobs]
+    lock = threading.Lock()
+
+    def use():
+        resource = pool.acquire()
+        job(0.01)
+        pool.release(resource)
+        with lock:
+            pending[0] -= 1
+
+    workers = dynpool.ThreadPool(min=jobs, max=jobs)
+    workers.grow(jobs)
+    elapsed, resizer = burst(
+        pool, lambda: workers.submit(use), jobs, lambda: not pending[0])
+    report('resources', pool, elapsed, resizer)
+    workers.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
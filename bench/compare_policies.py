@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Compare the resizing policies of dynpool with simulated workloads.
+
+Usage: python bench/compare_policies.py [duration]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dynpool
+
+
+WORKLOADS = [
+    ('poisson', dynpool.poisson_arrivals(50)),
+    ('bursty', dynpool.bursty_arrivals(20, 200, period=60, length=5)),
+    ('diurnal', dynpool.diurnal_arrivals(50, 0.8, period=600)),
+]
+
+POLICIES = [
+    ('spare', dynpool.SparePolicy),
+    ('predictive', dynpool.PredictivePolicy),
+    ('utilization', lambda: dynpool.TargetUtilizationPolicy(0.7)),
+    ('latency', lambda: dynpool.QueueLatencyPolicy(0.1, 0.2)),
+    ('slo', lambda: dynpool.LatencySLOPolicy(0.1)),
+]
+
+
+def main(duration):
+    print('{0:<10} {1:<12} {2:>8} {3:>8} {4:>12} {5:>7}'.format(
+        'workload', 'policy', 'p50', 'p99', 'res-seconds', 'actions'))
+    for workload, arrivals in WORKLOADS:
+        for name, policy in POLICIES:
+            simulation = dynpool.Simulation(
+                lambda pool, clock: dynpool.DynamicPoolResizer(
+                    pool, minspare=5, maxspare=10, clock=clock,
+                    policy=policy()),
+                arrivals=arrivals,
+                service=dynpool.exponential_service(0.2),
+                min=5, max=200)
+            report = simulation.run(duration)
+            print('{0:<10} {1:<12} {2:>8.3f} {3:>8.3f} {4:>12.0f} {5:>7}'
+                  .format(workload, name, report.wait_p50, report.wait_p99,
+                          report.resource_seconds,
+                          report.grows + report.shrinks))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 3600)
@@ -2,3 +2,8 @@ import os
 import sys
 
 sys.path.insert(0, os.path.dirname(__file__))
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # async/await syntax and asyncio.run().
+    collect_ignore += ['dynpool_asyncio.py', 'test/test_dynpool_asyncio.py']
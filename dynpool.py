@@ -13,7 +13,10 @@ licensed under the Apache License 2.0.
 concept of connections, threads or processes. That should be
 dealt in a provided pool object. ``dynpool`` only handles
 the growing and shrinking of resources in the given pool
-object, and for that, the pool must follow an interface:
+object, and for that, the pool must follow an interface
+(``dynpool`` also includes reference implementations:
+:py:class:`ThreadPool`, :py:class:`ProcessPool` and
+:py:class:`ResourcePool`):
 
 
 .. py:class:: PoolInterface
@@ -56,10 +59,83 @@ object, and for that, the pool must follow an interface:
 
       Creates ``amount`` new idle resources in the pool.
 
-   .. py:method:: shrink(amount)
+   .. py:method:: shrink(amount[, retire])
 
       Shrinks the pool by ``amount`` resources.
 
+      If the ``retire`` parameter of :py:class:`dynpool.DynamicPoolResizer`
+      is set, it is passed along as a hint of which resources should go
+      first: :py:data:`dynpool.RETIRE_IDLEST`,
+      :py:data:`dynpool.RETIRE_OLDEST`, :py:data:`dynpool.RETIRE_LARGEST`
+      or :py:data:`dynpool.RETIRE_MOST_USED`.
+      :py:class:`dynpool.IdleTracker` helps pools follow the hint.
+
+   The pool may also provide these optional methods and attributes.
+   ``dynpool`` looks the methods up in the pool's class, and will simply
+   not use them if they are missing:
+
+   .. py:method:: subscribe(callback)
+
+      Register ``callback`` to be called as ``callback(idle, qsize)``
+      every time the number of idle resources or the queue size changes.
+      Used by :py:class:`dynpool.PoolMonitor` to resize the pool as soon
+      as needed instead of polling it.
+
+   .. py:method:: unsubscribe(callback)
+
+      Remove a callback registered with :py:meth:`subscribe`.
+
+   .. py:method:: snapshot()
+
+      Return the values of :py:attr:`size`, :py:attr:`idle`,
+      :py:attr:`qsize`, :py:attr:`min` and :py:attr:`max` as a
+      :py:class:`dynpool.PoolSnapshot` or as a tuple in that order.
+      ``dynpool`` reads the pool state once per :py:meth:`run`, and when
+      reading every attribute separately is expensive (for instance
+      because they take a lock), a single call that returns consistent
+      values is cheaper.
+
+   .. py:attribute:: starting
+
+      The number of resources that are included in :py:attr:`size` but
+      are still warming up (importing modules, opening connections...)
+      and can't take jobs yet, so they aren't :py:attr:`idle`. The
+      resizer counts them as spare resources, so it doesn't grow the
+      pool again while they start, but it never shrinks them.
+
+   .. py:attribute:: standby
+
+      The number of pre-warmed resources kept outside of the pool,
+      including the ones still warming up.
+
+   .. py:method:: promote(amount)
+
+      Move up to ``amount`` standby resources into the pool, where they
+      are idle right away, and return how many were moved. The resizer
+      promotes standby resources before calling :py:meth:`grow`, so
+      bursts are served without waiting for new resources.
+
+   .. py:method:: prewarm(amount)
+
+      Create ``amount`` new standby resources. Called by the resizer to
+      keep its ``reserve`` of standby resources. It should return
+      quickly and count the resources it is still creating in
+      :py:attr:`standby`.
+
+   .. py:method:: waits()
+
+      Return the seconds that every job waited in the queue, for the
+      jobs that left the queue since the last call. Used by
+      :py:class:`dynpool.LatencySLOPolicy`.
+
+   .. py:method:: classes()
+
+      Return a mapping of names to the classes of resources of the pool
+      (like small and large workers, or replica and primary
+      connections). Every class is a pool that follows this interface,
+      with its own queue. Used by :py:class:`dynpool.ClassedResizer` to
+      resize every class on its own.
+
 
 Example
 
@@ -79,6 +155,12 @@ Example
     # call it's run() method periodically. Let's do it every second.
     run_periodically(monitor.run, interval=1)
 
+    # Or let dynpool do it for us in a background thread.
+    driver = dynpool.PoolMonitor(monitor, interval=1)
+    driver.start()
+    ...
+    driver.stop()
+
 
 ``dynpool`` has been tested in Python 2.6, 2.7, 3.2, 3.3 and
 PyPy 2.2. Other versions may work but are not supported.
@@ -89,10 +171,88 @@ PyPy 2.2. Other versions may work but are not supported.
 
 __version__ = '2.2'
 
+import bisect
+import errno
+import heapq
+import itertools
+import json
 import math
+import mmap
+import numbers
+import os
+import random
+import socket
+import struct
+import tempfile
 import threading
 import time
+import traceback
 import functools
+from array import array
+from collections import deque, namedtuple
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6. Only the order of classes and columns depends on it.
+    OrderedDict = dict
+
+
+# time.monotonic() is not available in Python 2.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _pool_method(pool, name):
+    """
+    Return the bound method ``name`` of an optional part of the pool
+    interface, or None if the pool doesn't implement it.
+
+    The method is looked up in the pool's class (like special methods
+    are), so objects that make up attributes on demand don't claim
+    to implement every optional method.
+    """
+    if getattr(type(pool), name, None) is None:
+        return None
+    return getattr(pool, name)
+
+
+def _pool_value(pool, name):
+    """
+    Return the value of the optional attribute ``name`` of the pool
+    interface, or 0 if the pool doesn't have it.
+
+    Only integers are accepted, so objects that make up attributes on
+    demand don't claim to have every optional value.
+    """
+    value = getattr(pool, name, 0)
+    if not isinstance(value, numbers.Integral):
+        return 0
+    return value
+
+
+def _nolog(msg):
+    pass
+
+
+# Weight of the newest sample in the resizer's cost averages.
+_COST_ALPHA = 0.3
+
+
+#: Retire the resources that have been idle for the longest time.
+RETIRE_IDLEST = 'idlest'
+#: Retire the resources that were created first.
+RETIRE_OLDEST = 'oldest'
+#: Retire the resources that take more memory (or any other measure).
+RETIRE_LARGEST = 'largest'
+#: Retire the resources that have handled more jobs.
+RETIRE_MOST_USED = 'most-used'
+
+#: The system has room for more resources.
+PRESSURE_OK = 0
+#: The system is busy: don't grow pools beyond their minimum size.
+PRESSURE_HIGH = 1
+#: The system is overloaded: shrink idle resources.
+PRESSURE_CRITICAL = 2
 
 
 def non_repeating(method):
@@ -116,6 +276,12 @@ def non_repeating(method):
     >>> add_item(None, 2)
     >>> x
     [1, 2, 3, 2]
+
+    .. deprecated:: 2.2
+       ``dynpool`` doesn't use it any more, it is only kept for backward
+       compatibility. The last call is shared by every instance, so it
+       must not be used on methods of objects that have several
+       instances: a call on one of them hides the same call on another.
     """
     last = []
     @functools.wraps(method)
@@ -128,6 +294,330 @@ def non_repeating(method):
     return wrapper
 
 
+class PoolSnapshot(namedtuple('PoolSnapshot', 'size idle qsize min max')):
+    """Immutable record of the state of a pool at a given moment.
+
+    Has the ``size``, ``idle``, ``qsize``, ``min`` and ``max`` fields of
+    :py:class:`PoolInterface`.
+    """
+    __slots__ = ()
+
+
+class ResizePolicy(object):
+    """Base class of the policies that decide how much a pool must grow
+    or shrink.
+
+    Policies receive the :py:class:`DynamicPoolResizer` that uses them, to
+    read settings like ``minspare`` and ``maxspare``, and the
+    :py:class:`PoolSnapshot` taken for the current run.
+
+    Subclasses only need to implement :py:meth:`delta`. Policies that
+    need different rules for growing and shrinking can override
+    :py:meth:`grow_value` and :py:meth:`shrink_value` instead.
+    """
+
+    def observe(self, resizer, snapshot, now):
+        """Called once at the start of every :py:meth:`~DynamicPoolResizer.run`
+        with the pool snapshot and the current time, so the policy can
+        keep statistics across runs. Does nothing by default.
+        """
+
+    def delta(self, resizer, snapshot, history):
+        """Return how many resources must be added to the pool (a positive
+        value) or removed from it (a negative value).
+
+        :param history: The recent ``(timestamp, snapshot)`` pairs seen by
+                        the resizer, oldest first. Includes the current
+                        snapshot when called from
+                        :py:meth:`~DynamicPoolResizer.run`.
+        """
+        raise NotImplementedError
+
+    def grow_value(self, resizer, snapshot):
+        """Return the number of resources the pool must grow by."""
+        return max(0, self.delta(resizer, snapshot, resizer.history))
+
+    def shrink_value(self, resizer, snapshot):
+        """Return the number of resources the pool must shrink by."""
+        return max(0, -self.delta(resizer, snapshot, resizer.history))
+
+    @staticmethod
+    def resize_to(snapshot, wanted):
+        """Return the delta that takes the pool to ``wanted`` resources,
+        respecting the pool's ``min`` and ``max`` and never removing
+        more resources than are idle.
+        """
+        wanted = max(wanted, snapshot.min)
+        if snapshot.max > 0:
+            wanted = min(wanted, snapshot.max)
+        return max(wanted - snapshot.size, -snapshot.idle)
+
+
+class SparePolicy(ResizePolicy):
+    """The default policy: keep between ``minspare`` and ``maxspare`` idle
+    resources, growing quickly when jobs are queued and shrinking slowly
+    when resources are idle.
+    """
+
+    def delta(self, resizer, snapshot, history):
+        return (self.grow_value(resizer, snapshot) or
+                -self.shrink_value(resizer, snapshot))
+
+    def grow_value(self, resizer, snapshot):
+        pool_size, pool_idle, pool_qsize, pool_min, pool_max = snapshot
+        maxspare = resizer.maxspare
+        minspare = resizer.minspare
+
+        if 0 < pool_max <= pool_size or pool_idle > maxspare:
+            growby = 0
+        elif not pool_idle and pool_qsize:
+            # UH OH, we don't have available threads to continue serving the
+            # queue. This means that we just received a lot of requests that we
+            # couldn't handle with our usual minspare threads value.
+            #
+            # So spawn enough threads such that we can cope with the
+            # number of waiting requests, and satisfy the minspare
+            # requirement at the same time (while adhering to the
+            # maximum number of threads).
+            if pool_max > 0:
+                growby = min(pool_qsize + minspare, pool_max - pool_size)
+            else:
+                # If we have no maximum defined, then don't try to factor
+                # pool_max into the equation.
+                growby = pool_qsize + minspare
+        else:
+            growby = max(0, pool_min - pool_size, minspare - pool_idle)
+        return growby
+
+    def shrink_value(self, resizer, snapshot):
+        pool_size, pool_idle, pool_qsize, pool_min, _ = snapshot
+        minspare = resizer.minspare
+        maxspare = resizer.maxspare
+        if pool_size <= pool_min:
+            # Never shrink below the min value
+            shrinkby = 0
+        elif pool_size == pool_idle and not pool_qsize:
+            # It's oh so quiet...
+            # All the threads are idle and there are no incoming requests.
+            # We go down to our initial threadpool size.
+            shrinkby = min(pool_size - pool_min, pool_idle - minspare)
+        elif pool_idle > maxspare:
+            # Leave only maxspare idle threads ready to accept connections.
+            shrinkby = pool_idle - maxspare
+        elif pool_idle > minspare + 1 and not pool_qsize:
+            # We have more than minspare threads idling, but no incoming
+            # connections to handle. Slowly shrink the thread pool by half
+            # (or by the resizer's shrinkratio) every time the Thread
+            # monitor runs (as long as there are no incoming connections).
+            #
+            # But make sure that we have one more thread than
+            # minspare to prevent creating another thread as soon as
+            # a request comes in.
+            shrinkby = min(
+                int(math.ceil((pool_idle - minspare) * resizer.shrinkratio)),
+                pool_idle - minspare - 1)
+        else:
+            shrinkby = 0
+        return shrinkby
+
+
+class PredictivePolicy(SparePolicy):
+    """Grow the pool ahead of demand.
+
+    The demand of the pool is the number of busy resources plus the
+    number of queued jobs. This policy keeps an exponentially weighted
+    moving average of how fast the demand changes between runs (the
+    arrival rate minus the throughput of the pool), and when the demand
+    is rising it grows the pool to what the demand will be ``horizon``
+    seconds later, plus ``minspare``. This way resources are ready before
+    the queue starts to fill up, instead of after.
+
+    It behaves like :py:class:`SparePolicy` otherwise, and never shrinks
+    the pool while the demand is rising.
+
+    :param alpha: Weight of the newest sample in the moving average,
+                  between 0 and 1.
+    :param horizon: Seconds to look ahead. A good value is the time it
+                    takes to create new resources plus the time between
+                    runs.
+    """
+    def __init__(self, alpha=0.3, horizon=2):
+        self.alpha = alpha
+        self.horizon = horizon
+        self.rate = 0.0
+        self.demand = None
+        self.lastobserved = None
+
+    def observe(self, resizer, snapshot, now):
+        demand = snapshot.size - snapshot.idle + snapshot.qsize
+        if self.lastobserved is not None:
+            elapsed = now - self.lastobserved
+            if elapsed <= 0:
+                return
+            rate = (demand - self.demand) / float(elapsed)
+            self.rate += self.alpha * (rate - self.rate)
+        self.demand = demand
+        self.lastobserved = now
+
+    def forecast(self, snapshot):
+        """Return the expected demand ``horizon`` seconds from now."""
+        demand = snapshot.size - snapshot.idle + snapshot.qsize
+        return demand + max(0.0, self.rate) * self.horizon
+
+    def grow_value(self, resizer, snapshot):
+        growby = super(PredictivePolicy, self).grow_value(resizer, snapshot)
+        pool_max = snapshot.max
+        if 0 < pool_max <= snapshot.size or self.rate <= 0:
+            return growby
+        wanted = int(math.ceil(self.forecast(snapshot))) + resizer.minspare
+        ahead = wanted - snapshot.size
+        if pool_max > 0:
+            ahead = min(ahead, pool_max - snapshot.size)
+        return max(growby, ahead)
+
+    def shrink_value(self, resizer, snapshot):
+        if self.rate > 0:
+            return 0
+        return super(PredictivePolicy, self).shrink_value(resizer, snapshot)
+
+
+class TargetUtilizationPolicy(ResizePolicy):
+    """Size the pool so a ``target`` fraction of its resources is busy.
+
+    The demand of the pool is the number of busy resources plus the
+    number of queued jobs. The pool grows as soon as the demand needs more
+    than ``size * target`` resources, but it only shrinks down to what the
+    peak demand in the resizer's history needs, so short lulls don't
+    release resources that will be needed again right away.
+
+    ``minspare`` and ``maxspare`` are not used by this policy.
+
+    :param target: Fraction of busy resources to aim for, like ``0.7``.
+    """
+    def __init__(self, target=0.7):
+        self.target = target
+
+    def wanted(self, demand):
+        return int(math.ceil(demand / float(self.target)))
+
+    def delta(self, resizer, snapshot, history):
+        demand = snapshot.size - snapshot.idle + snapshot.qsize
+        wanted = self.wanted(demand)
+        if wanted > snapshot.size:
+            return self.resize_to(snapshot, wanted)
+        peak = max([demand] + [s.size - s.idle + s.qsize
+                               for _, s in history])
+        # Only grow to reach the pool's min, never to a past peak.
+        return min(max(0, snapshot.min - snapshot.size),
+                   self.resize_to(snapshot, self.wanted(peak)))
+
+
+class QueueLatencyPolicy(ResizePolicy):
+    """Size the pool so queued jobs don't wait more than ``target``
+    seconds.
+
+    With ``size`` resources that take ``service_time`` seconds per job,
+    the last of ``qsize`` queued jobs waits about
+    ``qsize * service_time / size`` seconds, so the pool grows to
+    ``qsize * service_time / target`` resources when that is more than
+    it has. When the queue is empty it shrinks to the peak number of
+    busy resources in the resizer's history.
+
+    ``minspare`` and ``maxspare`` are not used by this policy.
+
+    :param target: Maximum seconds a job should wait in the queue.
+    :param service_time: Average seconds a resource needs to handle a job.
+    """
+    def __init__(self, target, service_time):
+        self.target = target
+        self.service_time = service_time
+
+    def delta(self, resizer, snapshot, history):
+        busy = snapshot.size - snapshot.idle
+        if snapshot.qsize:
+            wanted = int(math.ceil(
+                snapshot.qsize * self.service_time / float(self.target)))
+            return max(0, self.resize_to(snapshot, max(wanted, busy + 1)))
+        peak = max([busy] + [s.size - s.idle for _, s in history])
+        # Only grow to reach the pool's min, never to a past peak.
+        return min(max(0, snapshot.min - snapshot.size),
+                   self.resize_to(snapshot, peak))
+
+
+class LatencySLOPolicy(ResizePolicy):
+    """Keep the ``percentile`` of the time jobs wait in the queue under
+    ``target`` seconds, with as few resources as possible.
+
+    Needs a pool with a ``waits()`` method. Every run, the waits of the
+    jobs that left the queue since the previous run feed a PI
+    controller. The error is how far their percentile is from the
+    target, relative to the target. The integral term is the pool size,
+    and it moves by ``ki * error * size`` resources per second: while
+    waits are under the target it goes down, so the pool shrinks to the
+    smallest size that meets the target. The proportional term adds
+    ``kp * error * size`` resources on top of it. Waits are only known
+    once jobs leave the queue, so the pool also grows right away to as
+    many resources as the queued jobs need.
+
+    The integral never goes beyond the pool's ``min`` and ``max``, or
+    below the number of busy resources. When the pool didn't reach the
+    size wanted by the previous run, because of the resizer's ramp
+    settings, ``growfreq``, a budget or system pressure, the integral
+    goes back to the size the pool actually has. So it doesn't keep
+    winding up while the pool can't follow it, and the pool doesn't
+    overshoot once the saturation ends.
+
+    ``minspare`` and ``maxspare`` are not used by this policy.
+
+    :param target: Seconds jobs should wait in the queue at most.
+    :param percentile: Percentile of the waits compared to the target.
+    :param kp: Proportional gain.
+    :param ki: Integral gain, per second.
+    """
+    def __init__(self, target, percentile=95, kp=0.1, ki=0.05):
+        self.target = target
+        self.percentile = percentile
+        self.kp = kp
+        self.ki = ki
+        self.wait = 0.0
+        self.integral = None
+        self.wanted = None
+        self.lastobserved = None
+
+    def observe(self, resizer, snapshot, now):
+        waits = _pool_method(resizer.pool, 'waits')
+        if waits is None:
+            raise TypeError('LatencySLOPolicy needs a pool with a waits() '
+                            'method')
+        self.wait = _percentile(sorted(waits()), self.percentile)
+        error = (self.wait - self.target) / float(self.target)
+        scale = max(snapshot.size, 1)
+
+        integral = self.integral
+        if integral is None:
+            integral = float(snapshot.size)
+        elif now > self.lastobserved:
+            integral += self.ki * error * scale * (now - self.lastobserved)
+        self.lastobserved = now
+        # Anti-windup: keep the integral within what the pool can do, and
+        # did, since the previous run.
+        if self.wanted is not None and snapshot.size < self.wanted:
+            integral = min(integral, float(snapshot.size))
+        busy = snapshot.size - snapshot.idle
+        lowest = max(busy + 1 if snapshot.qsize else busy, snapshot.min)
+        integral = max(integral, lowest)
+        if snapshot.max > 0:
+            integral = min(integral, snapshot.max)
+        self.integral = integral
+        self.wanted = max(lowest, busy + snapshot.qsize, int(math.ceil(
+            integral + self.kp * error * scale)))
+
+    def delta(self, resizer, snapshot, history):
+        if self.wanted is None:
+            return 0
+        return self.resize_to(snapshot, self.wanted)
+
+
 class DynamicPoolResizer(object):
     """Grow or shrink a pool of resources depending on usage patterns.
 
@@ -136,149 +626,2790 @@ class DynamicPoolResizer(object):
     :param maxspare: Maximum number of idle resources available.
     :param shrinkfreq: Minimum seconds between shrink operations. Set to 0
                        to disable shrink checks.
+    :param growfreq: Minimum seconds between grow operations. Disabled by
+                     default.
+    :param shrinkafter: Number of consecutive runs that must want to shrink
+                        the pool before it is actually shrunk, so resources
+                        that are expensive to create survive short lulls.
+    :param metrics: :py:class:`ResizerMetrics` that will record the
+                    resizer activity. No metrics are recorded by default.
+    :param retire: Hint passed to ``pool.shrink()`` to choose which
+                   resources to remove, like :py:data:`RETIRE_IDLEST`.
+                   ``pool.shrink()`` is called without a hint by default.
+    :param maxgrow: Maximum number of resources created in a single run.
+    :param growrate: Maximum number of resources created per second, on
+                     average. Up to a second worth of resources can be
+                     created at once.
+    :param slowstart: Number of resources created by the first run that
+                      grows the pool after a period without growing. Every
+                      consecutive run that grows doubles it, so the pool
+                      still reaches the wanted size quickly.
+    :param recorder: :py:class:`DecisionRecorder` that will keep what every
+                     run saw and decided. Nothing is recorded by default.
+    :param reserve: Number of pre-warmed standby resources kept outside of
+                    the pool, for pools that implement ``prewarm()`` and
+                    ``promote()``. Growing the pool promotes standby
+                    resources first, and every run creates new ones to
+                    keep the reserve. No reserve by default.
+    :param pressure: :py:class:`SystemPressure` that limits the pool when
+                     the host is short of memory or CPU. On
+                     :py:data:`PRESSURE_HIGH` the pool only grows up to
+                     ``pool.min``, and on :py:data:`PRESSURE_CRITICAL` it
+                     also sheds half of its idle resources on every run
+                     allowed by ``shrinkfreq``.
+    :param profile: :py:class:`SizingProfile` that learns the demand of the
+                    pool at every time of the day. When the resizer
+                    starts, it grows the pool to the demand the profile
+                    expects at that time plus ``minspare``, and that
+                    floor decays back to the reactive behaviour during
+                    the profile's ``warmup`` seconds.
+    :param costaware: Adapt shrinking to how long ``pool.grow()`` takes to
+                      create a resource. The resizer always times the
+                      calls to ``pool.grow()`` and ``pool.shrink()`` and
+                      keeps the average seconds per resource in
+                      :py:attr:`growcost` and :py:attr:`shrinkcost`. With
+                      this setting, resources that are expensive to
+                      create are held longer and released in smaller
+                      steps, and cheap ones are released sooner.
+    :param costref: Seconds per created resource for which the resizer
+                    behaves as configured. Every 10 times more (or less)
+                    doubles (or halves) ``shrinkfreq``, within 4 times
+                    (or a fourth of) its value. See :py:attr:`costfactor`.
+    :param mininterval: Make :py:meth:`run` non-blocking, for applications
+                        where many threads call it opportunistically
+                        instead of running a monitor. A call returns right
+                        away, without doing anything, if another one is
+                        running, or if the last run started less than
+                        ``mininterval`` seconds ago (0 only skips
+                        concurrent calls). By default calls wait for each
+                        other and all of them run.
     :param logfreq: Minimum seconds between status logging. Set to 0 to disable
                     status logging (which is the default).
     :param logger: Callback that will act as a logger. There is no
                    logging by default
     :param mutex: Mutex used in :py:meth:`run()`.
                   A `threading.Lock()` object will be used by default.
+    :param executor: Executor (like a
+                     :py:class:`concurrent.futures.ThreadPoolExecutor`)
+                     used to call ``pool.grow()`` in the background, so slow
+                     resource creation doesn't block :py:meth:`run`.
+                     Resources being created are counted as idle resources
+                     until ``pool.grow()`` returns, so they aren't requested
+                     twice. By default ``pool.grow()`` is called directly.
+    :param policy: :py:class:`ResizePolicy` that computes how much to grow
+                   or shrink. A :py:class:`SparePolicy` by default.
+    :param historylen: Number of recent pool snapshots kept in
+                       :py:attr:`history` for the policy.
+    :param clock: Function that returns the current time in seconds.
+                  :py:func:`time.time` by default.
 
     You can set the frequency values to 0 to disable them.
+
+    The ramp settings (``maxgrow``, ``growrate`` and ``slowstart``) are
+    disabled by default. Their state is kept between runs, so a run
+    continues the ramp where the previous one left it, and the demand
+    that couldn't be satisfied yet is kept in :py:attr:`growdebt`.
     """
     def __init__(self, pool, minspare, maxspare, shrinkfreq=5, logfreq=0,
-                 logger=None, mutex=None):
+                 logger=None, mutex=None, executor=None, policy=None,
+                 historylen=60, clock=None, growfreq=0, shrinkafter=1,
+                 metrics=None, retire=None, maxgrow=0, growrate=0,
+                 slowstart=0, recorder=None, reserve=0, pressure=None,
+                 profile=None, costaware=False, costref=0.01,
+                 mininterval=None):
         self.pool = pool
         self.minspare = minspare
         self.maxspare = maxspare
         self.shrinkfreq = shrinkfreq
         self.logfreq = logfreq
-        self.log = logger or (lambda msg: None)
+        self.log = logger or _nolog
+        self.clock = clock or time.time
         self.lastshrink = None
         self.lastlog = None
+        self.growfreq = growfreq
+        self.shrinkafter = shrinkafter
+        self.lastgrow = None
+        self.lastaction = None
+        self.shrinkruns = 0
+        self.churn = 0
+        self.metrics = metrics
+        self.retire = retire
+        self.maxgrow = maxgrow
+        self.growrate = growrate
+        self.slowstart = slowstart
+        self.rampstep = 0
+        self.growdebt = 0
+        self._growtokens = None
+        self._growtokens_at = None
+        self.recorder = recorder
+        self.reserve = reserve
+        self.pressure = pressure
+        self.profile = profile
+        self._warm = None
+        self.costaware = costaware
+        self.costref = costref
+        self.growcost = None
+        self.shrinkcost = None
+        self.mininterval = mininterval
+        self._lastrun = None
         self._mutex = mutex or threading.Lock()
+        self._snapshot = None
+        self._pending = 0
+        self._proposal = None
+        self._lastlogged = None
+        self.executor = executor
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+        self.policy = policy or SparePolicy()
+        self.history = deque(maxlen=historylen)
 
     def run(self):
         """Perform maintenance operations.
 
        This method should be called periodically by a running application.
+
+       Return False if the call was skipped because of ``mininterval``,
+       True otherwise.
        """
-        with self._mutex:
-            grow_value = self.grow_value
-            if grow_value:
-                self.grow(grow_value)
-            elif self.can_shrink():
-                shrink_value = self.shrink_value
+        mininterval = self.mininterval
+        if mininterval is None:
+            with self._mutex:
+                self._run(_monotonic())
+            return True
+        # Check the time before trying the lock: under contention most
+        # calls end here, after reading the clock once.
+        last = self._lastrun
+        if last is not None and _monotonic() - last < mininterval:
+            return False
+        if not self._mutex.acquire(False):
+            return False
+        try:
+            # Another call may have run between the check and the lock.
+            started = _monotonic()
+            last = self._lastrun
+            if last is not None and started - last < mininterval:
+                return False
+            self._lastrun = started
+            self._run(started)
+        finally:
+            self._mutex.release()
+        return True
+
+    def _run(self, started):
+        self._snapshot = self.take_snapshot()
+        try:
+            action, amount = self._decide()
+            if action is not None:
+                action(amount)
+            self._refill()
+            self._finish_run(started)
+        finally:
+            self._snapshot = None
+
+    def take_snapshot(self):
+        """Read the current state of the pool as a
+        :py:class:`PoolSnapshot`, using the pool's ``snapshot()`` method
+        if it has one.
+
+        Resources still being created by the ``executor`` are added to
+        the ``size`` and ``idle`` values, and the pool's ``starting``
+        resources to the ``idle`` value, so they count as spare
+        resources when deciding to grow. They can't be removed yet, so
+        :py:attr:`shrink_value` never asks for more than the resources
+        that are really idle.
+        """
+        pool = self.pool
+        snapshot = _pool_method(pool, 'snapshot')
+        if snapshot is None:
+            snapshot = PoolSnapshot(
+                pool.size, pool.idle, pool.qsize, pool.min, pool.max)
+        else:
+            snapshot = snapshot()
+            if not isinstance(snapshot, PoolSnapshot):
+                snapshot = PoolSnapshot._make(snapshot)
+        inflight = self.inflight
+        starting = _pool_value(pool, 'starting')
+        self._pending = inflight + starting
+        if self._pending:
+            snapshot = snapshot._replace(
+                size=snapshot.size + inflight,
+                idle=snapshot.idle + self._pending)
+        return snapshot
+
+    def _shrinkable(self, snapshot):
+        """
+        Return how many resources of ``snapshot`` can be removed: the idle
+        ones, without those that are still being created or starting.
+        """
+        return max(0, snapshot.idle - self._pending)
+
+    def pool_snapshot(self):
+        """Return the pool state used for decisions.
+
+        Inside :py:meth:`run` this is the snapshot taken at the start of
+        the run, so every decision in a run sees the same consistent
+        values and the pool is only read once.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.take_snapshot()
+        return snapshot
+
+    def _decide(self):
+        """
+        Return the bound method that must be called in this run (either
+        :py:meth:`grow` or :py:meth:`shrink`) and its argument, or
+        ``(None, 0)`` if the pool is fine as it is.
+        """
+        action, amount = self._propose()
+        return self._commit(action, amount)
+
+    def _propose(self):
+        """
+        Return the name of the action wanted in this run (``'grow'``,
+        ``'shrink'`` or None) and its amount, without changing the state
+        the resizer keeps for the actions it takes.
+
+        :py:meth:`_commit` must be called next with the amount that is
+        actually granted, which a :py:class:`PoolCoordinator` may reduce.
+        """
+        snapshot, now = self.pool_snapshot(), self.clock()
+        self.history.append((now, snapshot))
+        self.policy.observe(self, snapshot, now)
+        floor = self._warm_floor(now)
+        grow_value = self.grow_value
+        if floor and floor > snapshot.size:
+            # Pre-grow to what the profile expects at this time.
+            pregrow = floor - snapshot.size
+            if snapshot.max > 0:
+                pregrow = min(pregrow, max(0, snapshot.max - snapshot.size))
+            grow_value = max(grow_value, pregrow)
+        shrink_value = 0
+        action, amount = None, 0
+        wanted, ramp = 0, None
+        level = PRESSURE_OK
+        if self.pressure is not None:
+            level = self.pressure.level()
+        if grow_value:
+            self.shrinkruns = 0
+            wanted = grow_value
+            if level != PRESSURE_OK:
+                wanted = min(wanted, max(0, snapshot.min - snapshot.size))
+            if wanted and self.can_grow():
+                amount, ramp = self._ramp(wanted, now)
+                if amount:
+                    action = 'grow'
+            else:
+                wanted = 0
+        if level == PRESSURE_CRITICAL and action is None:
+            # Shed idle resources even if the policy wants to keep them.
+            if self.can_shrink():
+                shrink_value = max(self.shrink_value, min(
+                    int(math.ceil(snapshot.idle / 2.0)),
+                    self._shrinkable(snapshot),
+                    max(0, snapshot.size - snapshot.min)))
+                if shrink_value:
+                    action, amount = 'shrink', shrink_value
+        elif not grow_value:
+            self.rampstep = 0
+            self.growdebt = 0
+            ready = True
+            if self.shrinkafter > 1:
+                # Count the consecutive runs that wanted to shrink, even if
+                # shrinkfreq doesn't allow to do it yet.
+                if self.shrinkfreq:
+                    shrink_value = self._floored_shrink(snapshot, floor)
                 if shrink_value:
-                    self.shrink(shrink_value)
-            if self.can_log():
-                self.queue_log()
-                self.lastlog = time.time()
+                    self.shrinkruns += 1
+                else:
+                    self.shrinkruns = 0
+                ready = self.shrinkruns >= self.shrinkafter
+            if ready and self.can_shrink():
+                if self.shrinkafter <= 1:
+                    shrink_value = self._floored_shrink(snapshot, floor)
+                if shrink_value:
+                    self.shrinkruns = 0
+                    action, amount = 'shrink', shrink_value
+        self._proposal = (now, snapshot, grow_value, shrink_value, wanted,
+                          ramp)
+        return action, amount
+
+    def _commit(self, action, amount):
+        """
+        Take the ``action`` proposed by :py:meth:`_propose` with the
+        ``amount`` that was granted, and return the bound method to call
+        like :py:meth:`_decide`. The ramp, the churn and the recorder only
+        account for what is granted, so a grow that isn't granted doesn't
+        ramp up.
+        """
+        now, snapshot, grow_value, shrink_value, wanted, ramp = (
+            self._proposal)
+        self._proposal = None
+        if wanted:
+            granted = amount if action == 'grow' else 0
+            self.growdebt = wanted - granted
+            self._ramp_done(granted, now, ramp)
+        if not amount:
+            action = None
+        if self.recorder is not None:
+            delta = 0
+            if action is not None:
+                delta = -amount if action == 'shrink' else amount
+            self.recorder.record(now, snapshot, grow_value, shrink_value,
+                                 delta)
+        if self.profile is not None:
+            self.profile.observe(now, snapshot)
+        if action is None:
+            return None, 0
+        return self._acting(action), amount
+
+    def _warm_floor(self, now):
+        """
+        Return the size the pool must keep while it warms up from its
+        sizing profile, which decays linearly to 0.
+        """
+        profile = self.profile
+        if profile is None:
+            return 0
+        if self._warm is None:
+            self._warm = (now, profile.expected(now) + self.minspare)
+        started, size = self._warm
+        if not size or now - started >= profile.warmup:
+            return 0
+        return int(math.ceil(
+            size * (1 - (now - started) / float(profile.warmup))))
+
+    def _floored_shrink(self, snapshot, floor):
+        shrink_value = self.shrink_value
+        if floor:
+            shrink_value = min(shrink_value, max(0, snapshot.size - floor))
+        return shrink_value
+
+    def _ramp(self, growby, now):
+        """
+        Limit the resources created in this run according to the
+        ``maxgrow``, ``slowstart`` and ``growrate`` settings.
+
+        Return the limited amount and the ``(step, tokens)`` of the ramp
+        that :py:meth:`_ramp_done` updates once the grow is granted.
+        """
+        step = tokens = None
+        if self.maxgrow:
+            growby = min(growby, self.maxgrow)
+        if self.slowstart:
+            step = self.rampstep or self.slowstart
+            growby = min(growby, step)
+        if self.growrate:
+            capacity = max(self.growrate, 1)
+            if self._growtokens is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, self._growtokens +
+                             (now - self._growtokens_at) * self.growrate)
+            growby = min(growby, int(tokens))
+        return growby, (step, tokens)
+
+    def _ramp_done(self, granted, now, ramp):
+        if ramp is None:
+            return
+        step, tokens = ramp
+        if step is not None and granted:
+            self.rampstep = step * 2
+        if tokens is not None:
+            self._growtokens = tokens - granted
+            self._growtokens_at = now
+
+    def _acting(self, name):
+        """
+        Return the ``name`` action method, keeping track of the churn: the
+        number of times the resizer switched between growing and
+        shrinking the pool.
+        """
+        if self.lastaction is not None and self.lastaction != name:
+            self.churn += 1
+        self.lastaction = name
+        return getattr(self, name)
+
+    def _finish_run(self, started):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe_run(self._snapshot, self.inflight,
+                                _monotonic() - started, self.clock())
+        if self.can_log():
+            self.queue_log()
+            self.lastlog = self.clock()
 
     def queue_log(self, msg=''):
-        pool = self.pool
-        self._log_if_new(pool.size, pool.idle, pool.qsize, msg)
+        if self.log is _nolog:
+            return
+        snapshot = self.pool_snapshot()
+        self._log_if_new(snapshot.size, snapshot.idle, snapshot.qsize, msg)
 
-    @non_repeating
-    def _log_if_new(self, pool_size, pool_idle, pool_qsize, msg):
+    def _log_if_new(self, pool_size, pool_idle, pool_qsize, msg,
+                    amount=None):
         """
-        Log the message, but as the result is cached, if the parameters
-        are the same as the last call, the behavior is bypassed.
+        Log the pool state, unless this resizer already logged the same
+        values last time. The message is only formatted when it is
+        actually logged, so repeated calls are almost free.
         """
+        last = self._lastlogged
+        if (last is not None and
+                last[0] == pool_size and
+                last[1] == pool_idle and
+                last[2] == pool_qsize and
+                last[3] == msg and
+                last[4] == amount):
+            return
+        self._lastlogged = (pool_size, pool_idle, pool_qsize, msg, amount)
+        if amount is not None:
+            msg = ' {0} by {1}'.format(msg, amount)
         self.log(
             'Thread pool: [current={0}/idle={1}/queue={2}]{3}'.format(
                 pool_size, pool_idle, pool_qsize, msg))
 
     def action_log(self, action, amount):
-        self.queue_log(' {0} by {1}'.format(action, amount))
+        if self.log is _nolog:
+            return
+        snapshot = self.pool_snapshot()
+        self._log_if_new(snapshot.size, snapshot.idle, snapshot.qsize,
+                         action, amount)
 
     @property
     def grow_value(self):
-        pool = self.pool
-        pool_size = pool.size
-        pool_min = pool.min
-        pool_max = pool.max
-        pool_idle = pool.idle
-        pool_qsize = pool.qsize
-        maxspare = self.maxspare
-        minspare = self.minspare
-
-        if 0 < pool_max <= pool_size or pool_idle > maxspare:
-            growby = 0
-        elif not pool_idle and pool_qsize:
-            # UH OH, we don't have available threads to continue serving the
-            # queue. This means that we just received a lot of requests that we
-            # couldn't handle with our usual minspare threads value.
-            #
-            # So spawn enough threads such that we can cope with the
-            # number of waiting requests, and satisfy the minspare
-            # requirement at the same time (while adhering to the
-            # maximum number of threads).
-            if pool_max > 0:
-                growby = min(pool_qsize + minspare, pool_max - pool_size)
-            else:
-                # If we have no maximum defined, then don't try to factor
-                # pool_max into the equation.
-                growby = pool_qsize + minspare
-        else:
-            growby = max(0, pool_min - pool_size, self.minspare - pool_idle)
-        return growby
+        return self.policy.grow_value(self, self.pool_snapshot())
 
     def grow(self, growby):
         self.action_log('Growing', growby)
-        self.pool.grow(growby)
+        self._record_action('grow', growby)
+        promote = _pool_method(self.pool, 'promote')
+        if promote is not None:
+            growby -= promote(growby) or 0
+            if growby <= 0:
+                return
+        executor = self.executor
+        if executor is None:
+            self._timed('grow', self.pool.grow, growby)
+            return
+        with self._inflight_lock:
+            self.inflight += growby
+        try:
+            future = executor.submit(
+                self._timed, 'grow', self.pool.grow, growby)
+        except Exception:
+            self._grow_done(growby, None)
+            raise
+        future.add_done_callback(functools.partial(self._grow_done, growby))
+
+    def _grow_done(self, growby, future):
+        with self._inflight_lock:
+            self.inflight -= growby
+        if future is not None and not future.cancelled():
+            exc = future.exception()
+            if exc is not None:
+                self.log('Thread pool: growing by {0} failed: {1!r}'.format(
+                    growby, exc))
+
+    @property
+    def prewarm_value(self):
+        """Number of standby resources needed to complete the reserve."""
+        if not self.reserve or _pool_method(self.pool, 'prewarm') is None:
+            return 0
+        return max(0, self.reserve - _pool_value(self.pool, 'standby'))
+
+    def prewarm(self, amount):
+        self.action_log('Prewarming', amount)
+        self.pool.prewarm(amount)
+
+    def _refill(self):
+        amount = self.prewarm_value
+        if amount:
+            self.prewarm(amount)
+
+    def _timed(self, name, method, amount):
+        """
+        Call ``method(amount)`` and account how long it took in
+        :py:attr:`growcost` or :py:attr:`shrinkcost`.
+        """
+        started = _monotonic()
+        result = method(amount)
+        self._observe_cost(name, amount, _monotonic() - started)
+        return result
+
+    def _observe_cost(self, name, amount, duration):
+        if amount <= 0:
+            return
+        cost = duration / amount
+        if name == 'grow':
+            last = self.growcost
+            self.growcost = cost if last is None else (
+                last + _COST_ALPHA * (cost - last))
+        else:
+            last = self.shrinkcost
+            self.shrinkcost = cost if last is None else (
+                last + _COST_ALPHA * (cost - last))
+        if self.metrics is not None:
+            self.metrics.observe_cost(name, amount, duration)
+
+    @property
+    def costfactor(self):
+        """How many times longer than configured idle resources are kept,
+        between 0.25 and 4. Always 1 unless ``costaware`` is set and a
+        grow was timed.
+        """
+        if not self.costaware or self.growcost is None:
+            return 1.0
+        ratio = max(self.growcost, 1e-9) / float(self.costref)
+        return min(4.0, max(0.25, 2 ** math.log10(ratio)))
+
+    @property
+    def shrinkratio(self):
+        """Fraction of the surplus of idle resources released at once by
+        gradual shrinks: a half, or less for expensive resources.
+        """
+        return min(1.0, 0.5 / self.costfactor)
 
     def can_shrink(self):
         return (
             self.shrinkfreq and
             (
-                not self.lastshrink
-                or time.time() - self.lastshrink > self.shrinkfreq
+                self.lastshrink is None
+                or self.clock() - self.lastshrink >
+                self.shrinkfreq * self.costfactor
             )
         )
 
+    def can_grow(self):
+        return (
+            not self.growfreq or
+            self.lastgrow is None or
+            self.clock() - self.lastgrow > self.growfreq
+        )
+
     def can_log(self):
         return (
             self.logfreq > 0 and
             (
-                not self.lastlog
-                or time.time() - self.lastlog > self.logfreq
+                self.lastlog is None
+                or self.clock() - self.lastlog > self.logfreq
             )
         )
 
     @property
     def shrink_value(self):
-        pool = self.pool
-        pool_size = pool.size
-        pool_min = pool.min
-        pool_idle = pool.idle
-        pool_qsize = pool.qsize
-        minspare = self.minspare
-        if pool_size <= pool_min:
-            # Never shrink below the min value
-            shrinkby = 0
-        elif pool_size == pool_idle and not pool_qsize:
-            # It's oh so quiet...
-            # All the threads are idle and there are no incoming requests.
-            # We go down to our initial threadpool size.
-            shrinkby = min(pool_size - pool_min, pool_idle - minspare)
-        elif pool_idle > self.maxspare:
-            # Leave only maxspare idle threads ready to accept connections.
-            shrinkby = pool_idle - self.maxspare
-        elif pool_idle > minspare + 1 and not pool_qsize:
-            # We have more than minspare threads idling, but no incoming
-            # connections to handle. Slowly shrink the thread pool by half
-            # every time the Thread monitor runs (as long as there are no
-            # incoming connections).
-            #
-            # But make sure that we have one more thread than
-            # minspare to prevent creating another thread as soon as
-            # a request comes in.
-            shrinkby = int(math.ceil((pool_idle - minspare) / 2.0))
-        else:
-            shrinkby = 0
-        return shrinkby
+        snapshot = self.pool_snapshot()
+        return min(self.policy.shrink_value(self, snapshot),
+                   self._shrinkable(snapshot))
 
     def shrink(self, shrinkby):
         self.action_log('Shrinking', shrinkby)
-        self.pool.shrink(shrinkby)
-        self.lastshrink = time.time()
+        self._record_action('shrink', shrinkby)
+        self._timed('shrink', self._pool_shrink, shrinkby)
+
+    def _pool_shrink(self, shrinkby):
+        if self.retire is None:
+            return self.pool.shrink(shrinkby)
+        return self.pool.shrink(shrinkby, retire=self.retire)
+
+    def _record_action(self, name, amount):
+        if name == 'grow':
+            self.lastgrow = self.clock()
+        else:
+            self.lastshrink = self.clock()
+        if self.metrics is not None:
+            self.metrics.observe_action(name, amount)
+
+    def needs_run(self, idle, qsize):
+        """Tell if a pool with the given number of ``idle`` resources and
+        ``qsize`` queued jobs may need to be resized.
+
+        This is a cheap check used to filter pool notifications, the
+        actual decision is still taken by :py:meth:`run`.
+        """
+        return (
+            (not idle and qsize) or
+            idle < self.minspare or
+            idle > self.maxspare
+        )
+
+
+class PoolMonitor(object):
+    """Call a resizer's :py:meth:`~DynamicPoolResizer.run` periodically
+    from a background thread.
+
+    :param resizer: A :py:class:`DynamicPoolResizer`, or any object with a
+                    ``run()`` method.
+    :param interval: Seconds between runs. Runs are scheduled on a fixed
+                     monotonic grid, so the time spent in ``run()`` doesn't
+                     make the schedule drift. Ticks that were missed
+                     because ``run()`` took too long are skipped.
+                     Set to None to only run when woken up by the pool.
+    :param debounce: Minimum seconds between runs. Wakeups received
+                     during this window are coalesced into a single run
+                     at the end of it.
+    :param name: Name of the background thread.
+    :param logger: Callback used to report errors raised by ``run()``.
+                   Defaults to the resizer's logger.
+
+    The thread is a daemon thread, so it won't keep the process alive,
+    but :py:meth:`stop` should be called for a clean shutdown.
+    """
+    def __init__(self, resizer, interval=1, debounce=0,
+                 name='dynpool-monitor', logger=None):
+        self.resizer = resizer
+        self.interval = interval
+        self.debounce = debounce
+        self.name = name
+        self.log = (
+            logger or getattr(resizer, 'log', None) or (lambda msg: None))
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._subscribed = None
+
+    @property
+    def running(self):
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self):
+        """Start the background thread."""
+        if self.running:
+            raise RuntimeError('Pool monitor already running')
+        self._stopping.clear()
+        self._wakeup.clear()
+        thread = threading.Thread(target=self._loop, name=self.name)
+        thread.daemon = True
+        self._thread = thread
+        thread.start()
+        subscribe = _pool_method(getattr(self.resizer, 'pool', None),
+                                 'subscribe')
+        if subscribe is not None:
+            subscribe(self.notify)
+            self._subscribed = self.resizer.pool
+
+    def stop(self, timeout=None):
+        """Stop the background thread and wait for it to finish.
+
+        :param timeout: Maximum seconds to wait for the thread.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        if self._subscribed is not None:
+            unsubscribe = _pool_method(self._subscribed, 'unsubscribe')
+            if unsubscribe is not None:
+                unsubscribe(self.notify)
+            self._subscribed = None
+        self._stopping.set()
+        self._wakeup.set()
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+        self._thread = None
+
+    def wakeup(self):
+        """Run the resizer as soon as possible instead of waiting for
+        the next scheduled tick.
+
+        Pools can call this when they detect queue pressure. Calls made
+        while a run is already pending are coalesced into a single run.
+        """
+        self._wakeup.set()
+
+    def notify(self, idle=None, qsize=None):
+        """Notification callback for pools that implement
+        ``subscribe()``.
+
+        Wakes the monitor up only if the new ``idle`` and ``qsize``
+        values may require a resize, so a pool in a steady state
+        doesn't cause any extra work.
+        """
+        if idle is not None and qsize is not None:
+            needs_run = getattr(self.resizer, 'needs_run', None)
+            if needs_run is not None and not needs_run(idle, qsize):
+                return
+        self._wakeup.set()
+
+    def _loop(self):
+        interval = self.interval
+        stopping = self._stopping
+        deadline = _monotonic()
+        while not stopping.is_set():
+            # Clear before running, so wakeups that arrive while run() is
+            # in progress trigger another run.
+            self._wakeup.clear()
+            try:
+                self.resizer.run()
+            except Exception as exc:
+                self.log('Pool monitor: run() failed: {0!r}'.format(exc))
+            if self.debounce:
+                stopping.wait(self.debounce)
+            if stopping.is_set():
+                break
+            if not interval:
+                self._wakeup.wait()
+                continue
+            now = _monotonic()
+            if now >= deadline:
+                # Move to the next point of the grid. An early wakeup
+                # leaves the deadline untouched.
+                deadline += interval * (int((now - deadline) // interval) + 1)
+            self._wakeup.wait(deadline - now)
+
+
+class PoolCoordinator(object):
+    """Run the resizers of several pools together, sharing a budget of
+    resources between them.
+
+    Every :py:meth:`run` lets each resizer decide as usual, then applies
+    all the shrinks, and finally hands out the remaining budget to the
+    pools that want to grow, those with more queued jobs per resource
+    first. Pools that don't fit in the budget grow less, or not at all.
+
+    The resizers must only be run by the coordinator. A
+    :py:class:`PoolMonitor` can drive the coordinator from a single
+    background thread:
+
+    .. code-block:: python
+
+        coordinator = dynpool.PoolCoordinator(budget=200)
+        coordinator.add(http_resizer)
+        coordinator.add(db_resizer, cost=4)
+        dynpool.PoolMonitor(coordinator, interval=1).start()
+
+    :param budget: Maximum total cost of the resources of all the pools.
+                   A negative value (the default) means no limit.
+    """
+    def __init__(self, budget=-1):
+        self.budget = budget
+        self.resizers = []
+        self._mutex = threading.Lock()
+
+    def add(self, resizer, cost=1):
+        """Coordinate ``resizer``, whose resources cost ``cost`` units of
+        the budget each.
+        """
+        with self._mutex:
+            self.resizers.append((resizer, cost))
+        return resizer
+
+    def remove(self, resizer):
+        """Stop coordinating ``resizer``."""
+        with self._mutex:
+            self.resizers = [
+                entry for entry in self.resizers if entry[0] is not resizer]
+
+    def used(self):
+        """Return the cost of all the resources in the pools."""
+        return sum(cost * resizer.pool_snapshot().size
+                   for resizer, cost in self.resizers)
+
+    def run(self):
+        """Perform maintenance operations in all the pools.
+
+        An error in a pool is logged with the logger of its resizer, and
+        the other pools are still resized. The resources of a pool that
+        can't be read don't count in the budget during that run.
+        """
+        with self._mutex:
+            started = _monotonic()
+            held = []
+            entries = []
+            try:
+                for resizer, cost in self.resizers:
+                    resizer._mutex.acquire()
+                    held.append(resizer)
+                    try:
+                        resizer._snapshot = resizer.take_snapshot()
+                    except Exception as exc:
+                        self._failed(resizer, exc)
+                    else:
+                        entries.append((resizer, cost))
+                self._arbitrate(entries)
+                for resizer, _ in entries:
+                    try:
+                        resizer._refill()
+                        resizer._finish_run(started)
+                    except Exception as exc:
+                        self._failed(resizer, exc)
+            finally:
+                for resizer in held:
+                    resizer._snapshot = None
+                    resizer._proposal = None
+                    resizer._mutex.release()
+
+    @staticmethod
+    def _failed(resizer, exc):
+        resizer.log('Pool coordinator: run() failed: {0!r}'.format(exc))
+
+    def _arbitrate(self, entries):
+        remaining = self.budget - sum(
+            cost * resizer.pool_snapshot().size for resizer, cost in entries)
+        grows = []
+        for resizer, cost in entries:
+            try:
+                name, amount = resizer._propose()
+                if name == 'grow':
+                    snapshot = resizer.pool_snapshot()
+                    pressure = (snapshot.qsize / float(max(snapshot.size, 1)),
+                                snapshot.qsize)
+                    grows.append((pressure, resizer, cost, amount))
+                    continue
+                action, amount = resizer._commit(name, amount)
+                if action is not None:
+                    action(amount)
+                    remaining += cost * amount
+            except Exception as exc:
+                self._failed(resizer, exc)
+        # Busiest pools first. Ties keep the order the resizers were added.
+        grows.sort(key=lambda grow: grow[0], reverse=True)
+        for _, resizer, cost, amount in grows:
+            if self.budget >= 0 and cost > 0:
+                amount = max(0, min(amount, int(remaining // cost)))
+            try:
+                action, amount = resizer._commit('grow', amount)
+                if action is not None:
+                    action(amount)
+                    remaining -= cost * amount
+            except Exception as exc:
+                self._failed(resizer, exc)
+
+
+class ClassedResizer(PoolCoordinator):
+    """Resize every class of resources of a pool with its own settings.
+
+    A :py:class:`DynamicPoolResizer` is created for every class returned
+    by the pool's ``classes()`` method, so a class only grows when its own
+    queue backs up, and jobs of a cheap class never make an expensive
+    class grow. The classes share the ``budget`` like the pools of a
+    :py:class:`PoolCoordinator`:
+
+    .. code-block:: python
+
+        resizer = dynpool.ClassedResizer(
+            pool, budget=64, shrinkfreq=10, settings={
+                'small': dict(minspare=4, maxspare=8),
+                'large': dict(minspare=0, maxspare=1, cost=8),
+            })
+        dynpool.PoolMonitor(resizer, interval=1).start()
+
+    :param pool: Pool with a ``classes()`` method, like a
+                 :py:class:`ClassedPool`, or a mapping of class names to
+                 pools.
+    :param settings: Mapping of class names to the parameters of their
+                     :py:class:`DynamicPoolResizer`, plus their ``cost``
+                     in the budget.
+    :param budget: Maximum total cost of the resources of all the
+                   classes. A negative value (the default) means no limit.
+    :param defaults: Parameters shared by the resizers of all the classes.
+    """
+    def __init__(self, pool, settings, budget=-1, **defaults):
+        super(ClassedResizer, self).__init__(budget)
+        self.pool = pool
+        classes = _pool_method(pool, 'classes')
+        classes = pool if classes is None else classes()
+        self.classes = OrderedDict()
+        for name, subpool in classes.items():
+            options = dict(defaults)
+            options.update(settings.get(name, {}))
+            cost = options.pop('cost', 1)
+            self.classes[name] = self.add(
+                DynamicPoolResizer(subpool, **options), cost)
+
+
+#
+# Metrics
+#
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets, like
+    Prometheus histograms.
+
+    :param buckets: Sorted upper bounds of the buckets. A last bucket for
+                    everything is implicit.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return ``(upper_bound, count)`` pairs with the number of values
+        lower or equal than each bound, ending with ``float('inf')``.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class ResizerMetrics(object):
+    """Counters, gauges and histograms of a :py:class:`DynamicPoolResizer`
+    activity. Pass an instance as the resizer's ``metrics`` parameter.
+
+    Counters: ``runs``, ``grows``, ``shrinks``, ``grown`` and ``shrunk``
+    (the last two add up the amounts).
+
+    Gauges: ``size``, ``idle``, ``qsize`` and ``inflight``, as seen by the
+    last run.
+
+    Histograms: ``run_seconds`` (duration of :py:meth:`run
+    <DynamicPoolResizer.run>`), ``pressure_seconds`` (duration of
+    the periods in which there were queued jobs but no idle resources),
+    and ``grow_seconds`` and ``shrink_seconds`` (duration of the calls to
+    ``pool.grow()`` and ``pool.shrink()``).
+
+    The values can be exported with :py:meth:`prometheus` or a
+    :py:class:`StatsdExporter`.
+    """
+    COUNTERS = (
+        ('runs', 'Number of resizer runs.'),
+        ('grows', 'Number of times the pool was grown.'),
+        ('shrinks', 'Number of times the pool was shrunk.'),
+        ('grown', 'Resources added to the pool.'),
+        ('shrunk', 'Resources removed from the pool.'),
+    )
+    GAUGES = (
+        ('size', 'Resources in the pool.'),
+        ('idle', 'Idle resources in the pool.'),
+        ('qsize', 'Jobs waiting in the queue.'),
+        ('inflight', 'Resources being created.'),
+    )
+    HISTOGRAMS = (
+        ('run_seconds', 'Duration of the resizer runs.'),
+        ('pressure_seconds',
+         'Duration of the periods with queued jobs and no idle resources.'),
+        ('grow_seconds', 'Duration of the pool grow calls.'),
+        ('shrink_seconds', 'Duration of the pool shrink calls.'),
+    )
+
+    def __init__(self,
+                 run_buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1),
+                 pressure_buckets=(.1, .5, 1, 2, 5, 10, 30, 60, 300),
+                 call_buckets=(.0001, .001, .01, .1, .5, 1, 5, 10, 30)):
+        self.runs = self.grows = self.shrinks = self.grown = self.shrunk = 0
+        self.size = self.idle = self.qsize = self.inflight = 0
+        self.run_seconds = Histogram(run_buckets)
+        self.pressure_seconds = Histogram(pressure_buckets)
+        self.grow_seconds = Histogram(call_buckets)
+        self.shrink_seconds = Histogram(call_buckets)
+        self.pressure_since = None
+
+    def observe_run(self, snapshot, inflight, duration, now):
+        """Record a run that saw ``snapshot`` and took ``duration``
+        seconds.
+        """
+        self.runs += 1
+        self.size = snapshot.size
+        self.idle = snapshot.idle
+        self.qsize = snapshot.qsize
+        self.inflight = inflight
+        self.run_seconds.observe(duration)
+        if not snapshot.idle and snapshot.qsize:
+            if self.pressure_since is None:
+                self.pressure_since = now
+        elif self.pressure_since is not None:
+            self.pressure_seconds.observe(now - self.pressure_since)
+            self.pressure_since = None
+
+    def observe_action(self, action, amount):
+        """Record a ``'grow'`` or ``'shrink'`` of ``amount`` resources."""
+        if action == 'grow':
+            self.grows += 1
+            self.grown += amount
+        else:
+            self.shrinks += 1
+            self.shrunk += amount
+
+    def observe_cost(self, action, amount, duration):
+        """Record a call to ``pool.grow()`` or ``pool.shrink()`` that took
+        ``duration`` seconds.
+        """
+        if action == 'grow':
+            self.grow_seconds.observe(duration)
+        else:
+            self.shrink_seconds.observe(duration)
+
+    def prometheus(self, prefix='dynpool', labels=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        :param labels: Dictionary of labels added to every sample, like
+                       ``{'pool': 'db'}``.
+        """
+        label_text = ','.join(
+            '{0}="{1}"'.format(name, _escape_label(value))
+            for name, value in sorted((labels or {}).items()))
+        plain = '{{{0}}}'.format(label_text) if label_text else ''
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        for attr, description in self.COUNTERS:
+            name = '{0}_{1}_total'.format(prefix, attr)
+            header(name, 'counter', description)
+            lines.append('{0}{1} {2}'.format(name, plain, getattr(self, attr)))
+        for attr, description in self.GAUGES:
+            name = '{0}_{1}'.format(prefix, attr)
+            header(name, 'gauge', description)
+            lines.append('{0}{1} {2}'.format(name, plain, getattr(self, attr)))
+        for attr, description in self.HISTOGRAMS:
+            name = '{0}_{1}'.format(prefix, attr)
+            histogram = getattr(self, attr)
+            header(name, 'histogram', description)
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{0}_bucket{{{1}le="{2}"}} {3}'.format(
+                    name, label_text + ',' if label_text else '', le, count))
+            lines.append('{0}_sum{1} {2!r}'.format(
+                name, plain, histogram.sum))
+            lines.append('{0}_count{1} {2}'.format(
+                name, plain, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    r"""
+    Escape a Prometheus label value.
+
+    >>> print(_escape_label('a "quoted"\\path'))
+    a \"quoted\"\\path
+    """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class StatsdExporter(object):
+    """Send :py:class:`ResizerMetrics` to a StatsD server over UDP.
+
+    Counters are sent as the increments since the last :py:meth:`send`,
+    gauges with their current value and histograms as the increments of
+    their sum and count. Sending doesn't fail if nobody is listening.
+
+    :param metrics: The :py:class:`ResizerMetrics` to export.
+    :param address: ``(host, port)`` of the StatsD server.
+    :param prefix: Prefix of the metric names.
+    """
+    def __init__(self, metrics, address=('127.0.0.1', 8125),
+                 prefix='dynpool'):
+        self.metrics = metrics
+        self.address = address
+        self.prefix = prefix
+        self._sent = {}
+        self._socket = None
+
+    def lines(self):
+        """Return the StatsD lines for the changes since the last call."""
+        metrics = self.metrics
+        counters = [(attr, getattr(metrics, attr))
+                    for attr, _ in metrics.COUNTERS]
+        for attr, _ in metrics.HISTOGRAMS:
+            histogram = getattr(metrics, attr)
+            counters.append((attr + '.sum', histogram.sum))
+            counters.append((attr + '.count', histogram.count))
+        lines = []
+        for name, value in counters:
+            increment = value - self._sent.get(name, 0)
+            self._sent[name] = value
+            if increment:
+                lines.append('{0}.{1}:{2}|c'.format(
+                    self.prefix, name, increment))
+        for attr, _ in metrics.GAUGES:
+            lines.append('{0}.{1}:{2}|g'.format(
+                self.prefix, attr, getattr(metrics, attr)))
+        return lines
+
+    def send(self):
+        """Send the changes since the last call in a single datagram."""
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        payload = '\n'.join(self.lines()).encode('ascii')
+        try:
+            self._socket.sendto(payload, self.address)
+        except socket.error:
+            pass
+
+
+#
+# Reference pools
+#
+
+class _Counter(object):
+    """
+    Counter that can be updated and read from several threads without a
+    lock. It is the length of a :py:class:`~collections.deque`, since
+    appending, popping and ``len()`` are atomic in CPython, so a read
+    never sees half of an update. Every ``decr()`` must follow its
+    ``incr()``.
+
+    >>> counter = _Counter()
+    >>> counter.incr(); counter.incr(); counter.decr()
+    >>> counter.value
+    1
+    """
+    def __init__(self):
+        self._items = deque()
+
+    def incr(self):
+        self._items.append(None)
+
+    def decr(self):
+        self._items.pop()
+
+    def take(self):
+        """Decrement the counter unless it is 0, and tell if it did."""
+        try:
+            self._items.pop()
+        except IndexError:
+            return False
+        return True
+
+    @property
+    def value(self):
+        return len(self._items)
+
+
+class _NotifyingPool(object):
+    """
+    Implements the optional ``subscribe()``, ``unsubscribe()`` and
+    ``snapshot()`` parts of the pool interface for the reference pools.
+    """
+    starting = 0
+
+    def __init__(self, min, max):
+        self.min = min
+        self.max = max
+        self._callbacks = ()
+
+    def subscribe(self, callback):
+        self._callbacks += (callback,)
+
+    def unsubscribe(self, callback):
+        self._callbacks = tuple(
+            registered for registered in self._callbacks
+            if registered != callback)
+
+    def snapshot(self):
+        return PoolSnapshot(self.size, self.idle, self.qsize,
+                            self.min, self.max)
+
+    def _notify(self):
+        callbacks = self._callbacks
+        if callbacks:
+            idle, qsize = self.idle, self.qsize
+            for callback in callbacks:
+                callback(idle, qsize)
+
+
+_STOP = object()
+
+# Queue waits kept by the reference pools until waits() is called.
+_WAITS_KEPT = 4096
+
+
+def _drain(waits):
+    """Pop all the items of a deque that other threads append to."""
+    drained = []
+    try:
+        while True:
+            drained.append(waits.popleft())
+    except IndexError:
+        return drained
+
+
+class ThreadPool(_NotifyingPool):
+    """Pool of worker threads that follows the :py:class:`PoolInterface`.
+
+    ``size``, ``idle`` and ``qsize`` are read without taking any lock.
+    The pool starts empty, use a :py:class:`DynamicPoolResizer` to grow
+    it to ``min`` threads.
+
+    :param min: Minimum number of threads.
+    :param max: Maximum number of threads, negative for no limit.
+    :param name: Prefix of the names of the threads.
+    :param logger: Callback used to report jobs that raised an exception.
+    """
+    def __init__(self, min=1, max=-1, name='dynpool-worker', logger=None):
+        super(ThreadPool, self).__init__(min, max)
+        self.name = name
+        self.log = logger or _nolog
+        self._jobs = deque()
+        self._ready = threading.Semaphore(0)
+        self._idle = _Counter()
+        self._stops = _Counter()
+        self._waits = deque(maxlen=_WAITS_KEPT)
+        self._workers = {}
+        self._names = itertools.count()
+
+    @property
+    def size(self):
+        return len(self._workers)
+
+    @property
+    def idle(self):
+        return self._idle.value
+
+    @property
+    def qsize(self):
+        return len(self._jobs)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call to ``func(*args, **kwargs)`` in a worker thread."""
+        self._jobs.append((func, args, kwargs, _monotonic()))
+        self._ready.release()
+        self._notify()
+
+    def grow(self, amount):
+        for _ in range(amount):
+            worker = threading.Thread(
+                target=self._work,
+                name='{0}-{1}'.format(self.name, next(self._names)))
+            worker.daemon = True
+            self._workers[worker] = True
+            # Count the worker as idle right away, or the next run of the
+            # resizer could grow the pool again before it starts.
+            self._idle.incr()
+            worker.start()
+
+    def shrink(self, amount, retire=None):
+        # All workers are equivalent, so there is no point in following
+        # the retire hint. Only idle workers that aren't stopping yet can
+        # be stopped.
+        self._stop(min(amount, self.idle - self._stops.value))
+
+    def _stop(self, amount):
+        # Stop signals are kept apart from the jobs, so they aren't
+        # counted in qsize, and workers only take them when there are no
+        # jobs queued.
+        for _ in range(amount):
+            self._stops.incr()
+            self._ready.release()
+
+    def waits(self):
+        return _drain(self._waits)
+
+    def shutdown(self, wait=True):
+        """Stop all the workers once they finish the queued jobs."""
+        workers = list(self._workers)
+        self._stop(len(workers))
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _next_job(self):
+        # Every release of the semaphore comes with a job or a stop
+        # signal, so one of them is there or about to be.
+        while True:
+            try:
+                return self._jobs.popleft()
+            except IndexError:
+                pass
+            if self._stops.take():
+                return _STOP
+            time.sleep(0)
+
+    def _work(self):
+        jobs, ready, idle = self._jobs, self._ready, self._idle
+        try:
+            while True:
+                ready.acquire()
+                idle.decr()
+                job = self._next_job()
+                if job is _STOP:
+                    break
+                func, args, kwargs, queued = job
+                self._waits.append(_monotonic() - queued)
+                try:
+                    func(*args, **kwargs)
+                except Exception as exc:
+                    self.log('Thread pool: job {0!r} failed: {1!r}'.format(
+                        func, exc))
+                idle.incr()
+                if not jobs:
+                    self._notify()
+        finally:
+            self._workers.pop(threading.current_thread(), None)
+
+
+class ResourcePool(_NotifyingPool):
+    """Pool of reusable objects, like database connections, that follows
+    the :py:class:`PoolInterface`.
+
+    Resources are created by ``factory()`` when the pool grows, taken
+    with :py:meth:`acquire` and given back with :py:meth:`release`.
+    ``qsize`` is the number of threads waiting for a resource. The most
+    recently released resources are handed out first, and the pool
+    shrinks by closing the resources that have been idle the longest,
+    unless a different ``retire`` hint is given and the pool has a
+    ``tracker``. Standby resources created by :py:meth:`prewarm` are
+    kept aside until :py:meth:`promote` moves them into the pool.
+
+    :param factory: Function that creates a new resource.
+    :param close: Function called with a resource when it is removed from
+                  the pool.
+    :param min: Minimum number of resources.
+    :param max: Maximum number of resources, negative for no limit.
+    :param tracker: :py:class:`IdleTracker` that keeps the statistics
+                    needed to follow the retire hints. Resources must be
+                    hashable to be tracked.
+    """
+    def __init__(self, factory, close=None, min=1, max=-1, tracker=None):
+        super(ResourcePool, self).__init__(min, max)
+        self.factory = factory
+        self.close = close or (lambda resource: None)
+        self.tracker = tracker
+        self._idle = deque()
+        self._standby = deque()
+        self._waits = deque(maxlen=_WAITS_KEPT)
+        self._available = threading.Semaphore(0)
+        self._size = _Counter()
+        self._waiting = _Counter()
+
+    @property
+    def size(self):
+        return self._size.value
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def qsize(self):
+        return self._waiting.value
+
+    @property
+    def standby(self):
+        return len(self._standby)
+
+    def acquire(self):
+        """Take a resource, waiting until one is available."""
+        if self._available.acquire(False):
+            self._waits.append(0.0)
+        else:
+            self._waiting.incr()
+            self._notify()
+            started = _monotonic()
+            try:
+                self._available.acquire()
+            finally:
+                self._waiting.decr()
+            self._waits.append(_monotonic() - started)
+        resource = self._idle.pop()
+        if self.tracker is not None:
+            self.tracker.acquired(resource)
+        return resource
+
+    def release(self, resource):
+        """Give back a resource taken with :py:meth:`acquire`."""
+        if self.tracker is not None:
+            self.tracker.released(resource)
+        self._idle.append(resource)
+        self._available.release()
+
+    def waits(self):
+        return _drain(self._waits)
+
+    def grow(self, amount):
+        for _ in range(amount):
+            self._add(self.factory())
+
+    def _add(self, resource):
+        self._size.incr()
+        if self.tracker is not None:
+            self.tracker.add(resource)
+        self.release(resource)
+
+    def prewarm(self, amount):
+        """Create ``amount`` standby resources."""
+        for _ in range(amount):
+            self._standby.append(self.factory())
+
+    def promote(self, amount):
+        """Move up to ``amount`` standby resources into the pool and
+        return how many were moved.
+        """
+        promoted = 0
+        while promoted < amount:
+            try:
+                resource = self._standby.popleft()
+            except IndexError:
+                break
+            self._add(resource)
+            promoted += 1
+        return promoted
+
+    def shrink(self, amount, retire=RETIRE_IDLEST):
+        tracker = self.tracker
+        for _ in range(amount):
+            if not self._available.acquire(False):
+                break
+            resource = None
+            if tracker is not None and retire != RETIRE_IDLEST:
+                chosen = tracker.select(
+                    1, retire, candidates=list(self._idle))
+                if chosen:
+                    try:
+                        self._idle.remove(chosen[0])
+                        resource = chosen[0]
+                    except ValueError:
+                        # Acquired by another thread in the meantime.
+                        pass
+            if resource is None:
+                resource = self._idle.popleft()
+            self._size.decr()
+            if tracker is not None:
+                tracker.discard(resource)
+            self.close(resource)
+
+
+class IdleTracker(object):
+    """Keep statistics of the resources of a pool, to choose which ones
+    to remove when the pool shrinks following a retire hint.
+
+    The pool calls :py:meth:`add` when it creates a resource,
+    :py:meth:`acquired` and :py:meth:`released` when a resource starts
+    and finishes a job, and :py:meth:`discard` when the resource is
+    removed. Resources must be hashable.
+
+    :param measure: Function that returns the size of a resource (like
+                    the RSS of a worker process), used by
+                    :py:data:`RETIRE_LARGEST`.
+    :param clock: Function that returns the current time in seconds.
+    """
+    def __init__(self, measure=None, clock=None):
+        self.measure = measure
+        self.clock = clock or time.time
+        self.created = {}
+        self.uses = {}
+        self.idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, resource):
+        now = self.clock()
+        with self._lock:
+            self.created[resource] = now
+            self.uses[resource] = 0
+            self.idle[resource] = now
+
+    def discard(self, resource):
+        with self._lock:
+            self.created.pop(resource, None)
+            self.uses.pop(resource, None)
+            self.idle.pop(resource, None)
+
+    def acquired(self, resource):
+        with self._lock:
+            self.uses[resource] = self.uses.get(resource, 0) + 1
+            self.idle.pop(resource, None)
+
+    def released(self, resource):
+        now = self.clock()
+        with self._lock:
+            # Move it to the end, so resources released at the same time
+            # keep their order.
+            self.idle.pop(resource, None)
+            self.idle[resource] = now
+
+    def select(self, amount, retire=RETIRE_IDLEST, candidates=None):
+        """Return up to ``amount`` idle resources that should be retired
+        first according to the ``retire`` hint.
+
+        :param candidates: Only choose among these resources.
+        """
+        with self._lock:
+            since = dict(self.idle)
+            idle = list(self.idle)
+            created = dict(self.created)
+            uses = dict(self.uses)
+        if candidates is not None:
+            allowed = set(candidates)
+            idle = [resource for resource in idle if resource in allowed]
+        if retire == RETIRE_IDLEST:
+            idle.sort(key=since.get)
+        elif retire == RETIRE_OLDEST:
+            idle.sort(key=lambda resource: created.get(resource, 0))
+        elif retire == RETIRE_MOST_USED:
+            idle.sort(key=lambda resource: uses.get(resource, 0),
+                      reverse=True)
+        elif retire == RETIRE_LARGEST and self.measure is not None:
+            idle.sort(key=self.measure, reverse=True)
+        return idle[:amount]
+
+
+_SLOT_FREE, _SLOT_STARTING, _SLOT_IDLE, _SLOT_BUSY = range(4)
+
+
+def _process_worker(jobs, states, taken, stopped, slot):
+    """
+    Main loop of the :py:class:`ProcessPool` workers. Every worker only
+    writes to its own slot of the shared ``states``, ``taken`` and
+    ``stopped`` arrays.
+    """
+    states[slot] = _SLOT_IDLE
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                stopped[slot] += 1
+                break
+            taken[slot] += 1
+            states[slot] = _SLOT_BUSY
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                traceback.print_exc()
+            states[slot] = _SLOT_IDLE
+    finally:
+        states[slot] = _SLOT_FREE
+
+
+class ProcessPool(_NotifyingPool):
+    """Pool of worker processes that follows the :py:class:`PoolInterface`.
+
+    Workers publish their state in shared memory, one slot per worker,
+    so ``size``, ``idle`` and ``qsize`` are read without any lock or
+    message passing. Jobs are sent through a
+    :py:class:`multiprocessing.Queue`, so they must be picklable.
+    Workers that are still starting are counted in ``starting``.
+
+    :param min: Minimum number of processes.
+    :param max: Maximum number of processes. It also sets the size of the
+                shared memory, so it can't be unlimited.
+    :param context: :py:mod:`multiprocessing` context used to create the
+                    processes and shared objects. The default context by
+                    default.
+    """
+    def __init__(self, min=1, max=16, context=None):
+        if max <= 0:
+            raise ValueError('ProcessPool needs a maximum size')
+        super(ProcessPool, self).__init__(min, max)
+        if context is None:
+            import multiprocessing as context
+        self.context = context
+        self._jobs = context.Queue()
+        self._states = context.RawArray('b', max)
+        self._taken = context.RawArray('L', max)
+        self._stopped = context.RawArray('L', max)
+        self._submitted = 0
+        self._stops = 0
+        self._processes = {}
+
+    @property
+    def size(self):
+        return self.max - self._states[:].count(_SLOT_FREE)
+
+    @property
+    def idle(self):
+        return self._states[:].count(_SLOT_IDLE)
+
+    @property
+    def starting(self):
+        return self._states[:].count(_SLOT_STARTING)
+
+    @property
+    def qsize(self):
+        return max(0, self._submitted - sum(self._taken))
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call to ``func(*args, **kwargs)`` in a worker process."""
+        self._submitted += 1
+        self._jobs.put((func, args, kwargs))
+        self._notify()
+
+    def grow(self, amount):
+        self._reap()
+        states = self._states
+        for slot in range(self.max):
+            if amount <= 0:
+                break
+            if states[slot] != _SLOT_FREE or slot in self._processes:
+                continue
+            states[slot] = _SLOT_STARTING
+            process = self.context.Process(
+                target=_process_worker,
+                args=(self._jobs, states, self._taken, self._stopped,
+                      slot))
+            process.daemon = True
+            process.start()
+            self._processes[slot] = process
+            amount -= 1
+
+    def shrink(self, amount, retire=None):
+        # Any idle worker takes the stop signal, retire hints are ignored.
+        # Only idle workers that aren't stopping yet can be stopped.
+        stopping = self._stops - sum(self._stopped)
+        self._stop(min(amount, self.idle - stopping))
+
+    def _stop(self, amount):
+        # Stop signals aren't counted as submitted jobs, so they aren't
+        # part of qsize.
+        for _ in range(amount):
+            self._stops += 1
+            self._jobs.put(None)
+
+    def shutdown(self, wait=True):
+        """Stop all the workers once they finish their queued jobs."""
+        self._stop(len(self._processes))
+        if wait:
+            for process in list(self._processes.values()):
+                process.join()
+            self._reap()
+
+    def _reap(self):
+        for slot, process in list(self._processes.items()):
+            if not process.is_alive():
+                process.join()
+                self._states[slot] = _SLOT_FREE
+                del self._processes[slot]
+
+
+def _sum_snapshots(snapshots):
+    """
+    Add up pool snapshots. The ``max`` of the sum is negative if any of
+    the pools has no limit.
+    """
+    totals = [0] * 5
+    unlimited = False
+    for snapshot in snapshots:
+        unlimited = unlimited or snapshot.max <= 0
+        for index, value in enumerate(snapshot):
+            totals[index] += value
+    if unlimited:
+        totals[4] = -1
+    return PoolSnapshot._make(totals)
+
+
+class ClassedPool(object):
+    """Pool made of several classes of resources, each one a pool that
+    follows the :py:class:`PoolInterface` with its own queue.
+
+    Its values are the sum of the values of its classes, and
+    :py:meth:`classes` gives them to a :py:class:`ClassedResizer` to
+    resize them one by one. When it is grown or shrunk as a whole, the
+    classes with more queued jobs per resource grow first, and the
+    classes with more idle resources shrink first. Every class stays
+    within its own ``min`` and ``max``, and what it can't take goes to
+    the next class.
+
+    :param classes: Mapping of names to pools. Use an
+                    :py:class:`~collections.OrderedDict` to choose the
+                    order of the classes.
+    """
+    def __init__(self, classes):
+        self._classes = OrderedDict(classes)
+
+    def classes(self):
+        return OrderedDict(self._classes)
+
+    def snapshot(self):
+        return _sum_snapshots(
+            PoolSnapshot(pool.size, pool.idle, pool.qsize, pool.min, pool.max)
+            for pool in self._classes.values())
+
+    size = property(lambda self: self.snapshot().size)
+    idle = property(lambda self: self.snapshot().idle)
+    qsize = property(lambda self: self.snapshot().qsize)
+    min = property(lambda self: self.snapshot().min)
+    max = property(lambda self: self.snapshot().max)
+
+    def grow(self, amount):
+        pools = sorted(self._classes.values(), reverse=True, key=lambda pool: (
+            pool.qsize / float(max(pool.size, 1))))
+        for pool in pools:
+            if amount <= 0:
+                break
+            growby = amount
+            if pool.max > 0:
+                growby = min(growby, pool.max - pool.size)
+            if growby > 0:
+                pool.grow(growby)
+                amount -= growby
+
+    def shrink(self, amount, retire=None):
+        pools = sorted(self._classes.values(), reverse=True,
+                       key=lambda pool: pool.idle)
+        for pool in pools:
+            if amount <= 0:
+                break
+            shrinkby = min(amount, pool.idle, pool.size - pool.min)
+            if shrinkby <= 0:
+                continue
+            if retire is None:
+                pool.shrink(shrinkby)
+            else:
+                pool.shrink(shrinkby, retire=retire)
+            amount -= shrinkby
+
+
+#
+# Multiprocess statistics
+#
+
+class SharedStats(object):
+    """Pool snapshots of several processes in shared memory.
+
+    Every process publishes the snapshot of its own pool in its own slot,
+    so there are no locks: a sequence number in every slot lets readers
+    detect and retry reads that overlapped with a write. Create it before
+    forking the worker processes, or give every process the same
+    ``path``.
+
+    :param slots: Maximum number of processes.
+    :param path: File used to share the memory between unrelated
+                 processes. By default the memory is anonymous and only
+                 shared with forked processes.
+    :param max_age: Seconds after which the snapshot of a process that
+                    stopped publishing is ignored.
+
+    A process killed in the middle of a write leaves its slot with an odd
+    sequence number. Readers ignore such a slot once its process is gone,
+    and the next :py:meth:`publish` in the slot repairs it. If the
+    process is alive but doesn't finish the write after a few retries,
+    readers use the last value they read from the slot.
+    """
+    SLOT = struct.Struct('=Qqd5q')
+    # Reads of a slot that is being written before giving up.
+    RETRIES = 100
+
+    def __init__(self, slots=64, path=None, max_age=10):
+        self.slots = slots
+        self.path = path
+        self.max_age = max_age
+        self._last = {}
+        length = slots * self.SLOT.size
+        if path is None:
+            self.memory = mmap.mmap(-1, length)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < length:
+                    os.ftruncate(fd, length)
+                self.memory = mmap.mmap(fd, length)
+            finally:
+                os.close(fd)
+
+    def __getstate__(self):
+        if self.path is None:
+            raise TypeError('anonymous SharedStats can only be shared with '
+                            'forked processes')
+        return self.slots, self.path, self.max_age
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def publish(self, slot, snapshot, now=None):
+        """Write ``snapshot`` in ``slot``. Only one process may use a slot."""
+        offset = slot * self.SLOT.size
+        memory = self.memory
+        # An odd sequence number tells readers that a write is going on.
+        # It may be left by a process that died while writing the slot.
+        seq = self.SLOT.unpack_from(memory, offset)[0]
+        seq -= seq % 2
+        struct.pack_into('=Q', memory, offset, seq + 1)
+        self.SLOT.pack_into(
+            memory, offset, seq + 1, os.getpid(),
+            time.time() if now is None else now, *snapshot)
+        struct.pack_into('=Q', memory, offset, seq + 2)
+
+    def release(self, slot):
+        """Mark ``slot`` as unused."""
+        offset = slot * self.SLOT.size
+        seq = self.SLOT.unpack_from(self.memory, offset)[0]
+        self.SLOT.pack_into(self.memory, offset, seq + 2 - seq % 2,
+                            0, 0.0, 0, 0, 0, 0, 0)
+
+    def read(self, slot):
+        """Return ``(pid, time, snapshot)`` of ``slot``, or None if it is
+        not used or its process died in the middle of a write.
+        """
+        offset = slot * self.SLOT.size
+        for _ in range(self.RETRIES):
+            values = self.SLOT.unpack_from(self.memory, offset)
+            if values[0] % 2 == 0 and struct.unpack_from(
+                    '=Q', self.memory, offset)[0] == values[0]:
+                break
+            # Let a writer that was preempted finish.
+            time.sleep(0)
+        else:
+            if not _process_alive(values[1]):
+                return None
+            return self._last.get(slot)
+        entry = None
+        if values[1]:
+            entry = values[1], values[2], PoolSnapshot._make(values[3:])
+        self._last[slot] = entry
+        return entry
+
+    def aggregate(self, now=None):
+        """Return the sum of the recent snapshots of all the processes, and
+        the number of processes, as a ``(snapshot, processes)`` pair.
+
+        The aggregated ``max`` is negative if any process has no limit.
+        """
+        now = time.time() if now is None else now
+        snapshots = []
+        for slot in range(self.slots):
+            entry = self.read(slot)
+            if entry is not None and now - entry[1] <= self.max_age:
+                snapshots.append(entry[2])
+        return _sum_snapshots(snapshots), len(snapshots)
+
+
+def _process_alive(pid):
+    """Tell if the process ``pid`` exists."""
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        # EPERM: it exists, but belongs to another user.
+        return exc.errno == errno.EPERM
+    return True
+
+
+class SharedStatsPool(object):
+    """Make a :py:class:`DynamicPoolResizer` decide from the pools of all
+    the processes that share a :py:class:`SharedStats`.
+
+    Wraps the pool of one process and follows the
+    :py:class:`PoolInterface`: its values are the sum of the values of
+    all the processes, and when the resizer grows or shrinks it, the
+    wrapped pool only takes its share. Resources are added to the
+    processes with more queued jobs and removed from the processes with
+    more idle resources, so every process can run its own resizer
+    without all of them growing at once.
+
+    :param pool: The pool of this process.
+    :param stats: The shared :py:class:`SharedStats`.
+    :param slot: Slot of this process in ``stats``.
+    """
+    def __init__(self, pool, stats, slot):
+        self.pool = pool
+        self.stats = stats
+        self.slot = slot
+        self.local = None
+        self.total = None
+        self.processes = 0
+
+    def snapshot(self):
+        """Publish the snapshot of the local pool and return the
+        aggregated one.
+        """
+        pool = self.pool
+        snapshot = _pool_method(pool, 'snapshot')
+        if snapshot is None:
+            local = PoolSnapshot(
+                pool.size, pool.idle, pool.qsize, pool.min, pool.max)
+        else:
+            local = PoolSnapshot._make(snapshot())
+        self.stats.publish(self.slot, local)
+        self.local = local
+        self.total, self.processes = self.stats.aggregate()
+        return self.total
+
+    size = property(lambda self: self.snapshot().size)
+    idle = property(lambda self: self.snapshot().idle)
+    qsize = property(lambda self: self.snapshot().qsize)
+    min = property(lambda self: self.snapshot().min)
+    max = property(lambda self: self.snapshot().max)
+
+    def _share(self, amount, local, total):
+        if total > 0:
+            return int(math.ceil(amount * local / float(total)))
+        return int(math.ceil(amount / float(max(self.processes, 1))))
+
+    def grow(self, amount):
+        local = self.local or self.pool
+        share = self._share(amount, local.qsize, self.total.qsize)
+        if local.max > 0:
+            share = min(share, local.max - local.size)
+        if share > 0:
+            self.pool.grow(share)
+
+    def shrink(self, amount, retire=None):
+        local = self.local or self.pool
+        share = self._share(amount, local.idle, self.total.idle)
+        share = min(share, local.idle, local.size - local.min)
+        if share > 0:
+            if retire is None:
+                self.pool.shrink(share)
+            else:
+                self.pool.shrink(share, retire=retire)
+
+
+#
+# System pressure
+#
+
+PressureReading = namedtuple('PressureReading', 'free load psi')
+
+
+class SystemPressure(object):
+    """Tell how loaded the host is, so a :py:class:`DynamicPoolResizer`
+    with a ``pressure`` stops growing pools on a busy host and shrinks
+    them on an overloaded one.
+
+    Every limit is a ``(high, critical)`` pair, and a limit set to None
+    is not checked. The readings come from Linux's ``/proc`` and cgroup
+    v2 files; the ones that are not available are ignored. They are
+    cached for ``interval`` seconds, so many resizers can share a single
+    instance cheaply.
+
+    :param free: Minimum fraction of free memory. The available memory
+                 of the host or, if it's lower, of the cgroup's
+                 ``memory.max`` limit.
+    :param load: Maximum 1 minute load average per CPU. The CPUs are
+                 limited by the cgroup's ``cpu.max`` quota.
+    :param psi: Maximum percentage of time in the last 10 seconds that
+                some tasks were stalled waiting for CPU or memory,
+                from ``/proc/pressure``.
+    :param interval: Seconds a reading is cached.
+    :param proc: Mount point of the proc filesystem.
+    :param cgroup: Directory of the cgroup of the process.
+    """
+    def __init__(self, free=(0.1, 0.05), load=None, psi=None, interval=1,
+                 proc='/proc', cgroup='/sys/fs/cgroup'):
+        self.free = free
+        self.load = load
+        self.psi = psi
+        self.interval = interval
+        self.proc = proc
+        self.cgroup = cgroup
+        self._reading = None
+        self._read_at = None
+
+    def read(self):
+        """Return a :py:class:`PressureReading` with the fraction of free
+        memory, the load per CPU and the stalled time percentage. Values
+        that can't be read are None.
+        """
+        now = _monotonic()
+        if (self._reading is None or
+                now - self._read_at >= self.interval):
+            self._reading = PressureReading(
+                self._read_free(), self._read_load(), self._read_psi())
+            self._read_at = now
+        return self._reading
+
+    def level(self):
+        """Return :py:data:`PRESSURE_OK`, :py:data:`PRESSURE_HIGH` or
+        :py:data:`PRESSURE_CRITICAL`.
+        """
+        free, load, psi = self.read()
+        level = PRESSURE_OK
+        for value, limits, above in ((free, self.free, False),
+                                     (load, self.load, True),
+                                     (psi, self.psi, True)):
+            if value is None or limits is None:
+                continue
+            for limit_level, limit in ((PRESSURE_CRITICAL, limits[1]),
+                                       (PRESSURE_HIGH, limits[0])):
+                if value > limit if above else value < limit:
+                    level = max(level, limit_level)
+                    break
+        return level
+
+    def _lines(self, *path):
+        try:
+            with open(os.path.join(*path)) as f:
+                return f.read().splitlines()
+        except (IOError, OSError):
+            return []
+
+    def _fields(self, *path):
+        fields = {}
+        for line in self._lines(*path):
+            parts = line.replace(':', ' ').split()
+            if len(parts) >= 2:
+                fields[parts[0]] = parts[1:]
+        return fields
+
+    def _read_free(self):
+        free = None
+        meminfo = self._fields(self.proc, 'meminfo')
+        if 'MemTotal' in meminfo and 'MemAvailable' in meminfo:
+            free = (float(meminfo['MemAvailable'][0]) /
+                    float(meminfo['MemTotal'][0]))
+        limit = self._lines(self.cgroup, 'memory.max')
+        current = self._lines(self.cgroup, 'memory.current')
+        if limit and current and limit[0] != 'max':
+            limit = float(limit[0])
+            # Page cache that can be reclaimed doesn't count as used.
+            used = float(current[0]) - float(self._fields(
+                self.cgroup, 'memory.stat').get('inactive_file', [0])[0])
+            cgroup_free = max(0.0, 1 - used / limit)
+            free = cgroup_free if free is None else min(free, cgroup_free)
+        return free
+
+    def _read_load(self):
+        loadavg = self._lines(self.proc, 'loadavg')
+        if not loadavg:
+            return None
+        cpus = float(_cpu_count())
+        quota = self._lines(self.cgroup, 'cpu.max')
+        if quota and not quota[0].startswith('max'):
+            quota, period = quota[0].split()
+            cpus = min(cpus, float(quota) / float(period))
+        return float(loadavg[0].split()[0]) / cpus
+
+    def _read_psi(self):
+        stalled = None
+        for resource in ('cpu', 'memory'):
+            for line in self._lines(self.proc, 'pressure', resource):
+                if line.startswith('some '):
+                    value = float(dict(field.split('=')
+                                       for field in line.split()[1:])['avg10'])
+                    stalled = value if stalled is None else max(stalled, value)
+        return stalled
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+#
+# Sizing profiles
+#
+
+class SizingProfile(object):
+    """Demand of a pool at every time of the day, saved in a file so a
+    restarted :py:class:`DynamicPoolResizer` doesn't start cold.
+
+    The day (or any ``period``) is split in ``buckets``, and every bucket
+    keeps a moving average of the peak demand (busy resources plus queued
+    jobs) seen during it. The peak of the current bucket is kept too, so
+    a process restarted a few moments later expects at least that.
+
+    The profile is saved every ``save_every`` seconds, and can be saved
+    explicitly with :py:meth:`save` before exiting. The file is replaced
+    atomically, so a crash never leaves a half written profile. A missing
+    or unreadable file is an empty profile.
+
+    :param path: File where the profile is kept.
+    :param buckets: Number of time windows in a period.
+    :param period: Seconds of a period. A day by default.
+    :param alpha: Weight of the newest peak in the moving averages,
+                  between 0 and 1.
+    :param warmup: Seconds the resizer takes to go back from the size of
+                   the profile to the reactive behaviour.
+    :param save_every: Minimum seconds between automatic saves.
+    """
+    VERSION = 1
+
+    def __init__(self, path, buckets=48, period=86400, alpha=0.5,
+                 warmup=300, save_every=60):
+        self.path = path
+        self.buckets = buckets
+        self.period = period
+        self.alpha = alpha
+        self.warmup = warmup
+        self.save_every = save_every
+        self.peaks = [None] * buckets
+        self.bucket = None
+        self.current = 0
+        self.savedat = None
+        self.load()
+
+    def bucket_at(self, now):
+        """Return the bucket of the time ``now``."""
+        return int(now % self.period * self.buckets // self.period)
+
+    def expected(self, now):
+        """Return the demand expected at the time ``now``."""
+        bucket = self.bucket_at(now)
+        expected = self.peaks[bucket] or 0
+        if (bucket == self.bucket and self.savedat is not None and
+                now - self.savedat < self.period / float(self.buckets)):
+            expected = max(expected, self.current)
+        return int(math.ceil(expected))
+
+    def observe(self, now, snapshot):
+        """Account the demand of ``snapshot``, and save the profile if it
+        is time to.
+        """
+        bucket = self.bucket_at(now)
+        if bucket != self.bucket:
+            self._fold()
+            self.bucket = bucket
+            self.current = 0
+        self.current = max(self.current,
+                           snapshot.size - snapshot.idle + snapshot.qsize)
+        if self.savedat is None:
+            self.savedat = now
+        elif now - self.savedat >= self.save_every:
+            self.save(now)
+
+    def _fold(self):
+        bucket = self.bucket
+        if bucket is None:
+            return
+        peak = self.peaks[bucket]
+        if peak is None:
+            peak = self.current
+        else:
+            peak += self.alpha * (self.current - peak)
+        self.peaks[bucket] = round(peak, 2)
+
+    def load(self):
+        """Read the profile from its file."""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if not self._valid(data):
+            return
+        self.peaks = data['peaks']
+        self.bucket = data['bucket']
+        self.current = data['current']
+        self.savedat = data['saved']
+
+    def _valid(self, data):
+        """
+        Tell if ``data`` read from the file is a profile with the same
+        settings, with all of its values.
+        """
+        if (not isinstance(data, dict) or
+                data.get('version') != self.VERSION or
+                data.get('period') != self.period):
+            return False
+        peaks, bucket = data.get('peaks'), data.get('bucket')
+        return (
+            isinstance(peaks, list) and len(peaks) == self.buckets and
+            all(peak is None or isinstance(peak, numbers.Real)
+                for peak in peaks) and
+            (bucket is None or isinstance(bucket, int) and
+             0 <= bucket < self.buckets) and
+            isinstance(data.get('current'), numbers.Real) and
+            isinstance(data.get('saved'), (numbers.Real, type(None))))
+
+    def save(self, now=None):
+        """Write the profile to its file."""
+        now = time.time() if now is None else now
+        data = json.dumps({
+            'version': self.VERSION,
+            'period': self.period,
+            'peaks': self.peaks,
+            'bucket': self.bucket,
+            'current': self.current,
+            'saved': now,
+        }, separators=(',', ':'))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.dynpool-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            _replace(temp, self.path)
+        except Exception:
+            os.unlink(temp)
+            raise
+        self.savedat = now
+
+
+# os.replace() is not available in Python 2, where os.rename() overwrites
+# files on POSIX systems.
+_replace = getattr(os, 'replace', os.rename)
+
+
+#
+# Decision history
+#
+
+class Decision(namedtuple('Decision', [
+        'time', 'size', 'idle', 'qsize', 'min', 'max',
+        'grow_value', 'shrink_value', 'delta'])):
+    """A run recorded by a :py:class:`DecisionRecorder`: the time and pool
+    snapshot it saw, the ``grow_value`` and ``shrink_value`` it computed
+    (``shrink_value`` is 0 when it wasn't needed) and the ``delta`` it
+    applied to the pool (positive when growing, negative when
+    shrinking).
+    """
+    __slots__ = ()
+
+    @property
+    def snapshot(self):
+        return PoolSnapshot(self.size, self.idle, self.qsize,
+                            self.min, self.max)
+
+
+class DecisionRecorder(object):
+    """Ring buffer with the last ``capacity`` decisions of a
+    :py:class:`DynamicPoolResizer`, stored in compact arrays.
+
+    Pass it as the ``recorder`` parameter of the resizer, then
+    :py:meth:`dump` it when the pool misbehaves and study it with
+    :py:func:`replay`.
+    """
+    HEADER = '# dynpool decisions v1: ' + ' '.join(Decision._fields)
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = [array('l', [0]) * capacity
+                       for _ in Decision._fields[1:]]
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def record(self, now, snapshot, grow_value, shrink_value, delta):
+        position = self.count % self.capacity
+        self.times[position] = now
+        for column, value in zip(self.values, (
+                snapshot.size, snapshot.idle, snapshot.qsize, snapshot.min,
+                snapshot.max, grow_value, shrink_value, delta)):
+            column[position] = value
+        self.count += 1
+
+    def __iter__(self):
+        """Iterate over the recorded :py:class:`Decision` objects, oldest
+        first.
+        """
+        start = self.count - len(self)
+        for index in range(start, self.count):
+            position = index % self.capacity
+            yield Decision(self.times[position],
+                           *[column[position] for column in self.values])
+
+    def columns(self):
+        """Return the recorded values as a dictionary of arrays, one per
+        :py:class:`Decision` field, oldest first. Ready for
+        :py:func:`evaluate_grid`.
+        """
+        start = self.count % self.capacity if self.count > self.capacity \
+            else 0
+        end = len(self)
+        return OrderedDict(
+            (name, column[start:end] + column[:start])
+            for name, column in zip(Decision._fields,
+                                    [self.times] + self.values))
+
+    def dump(self, fileobj):
+        """Write the recorded decisions to a text file object, one line
+        per decision.
+        """
+        fileobj.write(self.HEADER + '\n')
+        for decision in self:
+            fileobj.write('{0!r} {1}\n'.format(
+                decision.time, ' '.join(str(value)
+                                        for value in decision[1:])))
+
+    @staticmethod
+    def load(fileobj):
+        """Read the decisions written by :py:meth:`dump` and return them
+        as a list.
+        """
+        decisions = []
+        for line in fileobj:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            decisions.append(Decision(
+                float(fields[0]), *[int(field) for field in fields[1:]]))
+        return decisions
+
+
+class _ReplayPool(object):
+    """Pool that returns recorded snapshots, used by :py:func:`replay`."""
+    def __init__(self):
+        self.current = None
+        self.delta = 0
+
+    def snapshot(self):
+        return self.current
+
+    def grow(self, amount):
+        self.delta += amount
+
+    def shrink(self, amount, retire=None):
+        self.delta -= amount
+
+
+def replay(decisions, resizer_factory):
+    """Run recorded decisions through another resizer, to show what it
+    would have done.
+
+    Every recorded pool snapshot is fed to a new resizer, created with
+    ``resizer_factory(pool, clock)`` like in :py:class:`Simulation`,
+    which sees the recorded times as its clock. The pool doesn't change
+    with the new decisions, so this shows what the new resizer would have
+    done in each run, not how the pool would have evolved.
+
+    Return a list of ``(decision, delta)`` pairs with each recorded
+    :py:class:`Decision` and the delta of the new resizer.
+    """
+    pool = _ReplayPool()
+    now = [0.0]
+    resizer = resizer_factory(pool, lambda: now[0])
+    results = []
+    for decision in decisions:
+        now[0] = decision.time
+        pool.current = decision.snapshot
+        pool.delta = 0
+        resizer.run()
+        results.append((decision, pool.delta))
+    return results
+
+
+GridEvaluation = namedtuple('GridEvaluation', [
+    'settings', 'resource_seconds', 'queue_seconds',
+    'grows', 'shrinks', 'grown', 'shrunk'])
+
+
+class _ScalarOps(object):
+    """The NumPy functions used by :py:func:`_spare_delta`, for scalars."""
+    minimum = staticmethod(min)
+    maximum = staticmethod(max)
+
+    @staticmethod
+    def where(condition, value, otherwise):
+        return value if condition else otherwise
+
+
+def _spare_delta(ops, size, demand, pmin, pmax, minspare, maxspare,
+                 shrinkable):
+    """
+    The decision of a resizer with a :py:class:`SparePolicy`, written so
+    it works both with scalars and with NumPy arrays of settings.
+    """
+    busy = ops.minimum(demand, size)
+    idle = size - busy
+    qsize = demand - busy
+    limited = pmax > 0
+
+    rush = qsize + minspare
+    if limited:
+        rush = ops.minimum(rush, pmax - size)
+    steady = ops.maximum(ops.maximum(0, pmin - size), minspare - idle)
+    grow = ops.where(
+        (limited & (pmax <= size)) | (idle > maxspare), 0,
+        ops.where((idle == 0) & (qsize > 0), rush, steady))
+
+    quiet = ops.minimum(size - pmin, idle - minspare)
+    gradual = ops.minimum((idle - minspare + 1) // 2, idle - minspare - 1)
+    shrink = ops.where(
+        size <= pmin, 0, ops.where(
+            (size == idle) & (qsize == 0), quiet, ops.where(
+                idle > maxspare, idle - maxspare, ops.where(
+                    (idle > minspare + 1) & (qsize == 0), gradual, 0))))
+    return ops.where(grow != 0, grow,
+                     ops.where(shrinkable & (shrink != 0), -shrink, 0))
+
+
+def evaluate_grid(columns, settings, numpy=None):
+    """Evaluate many settings of a resizer with a :py:class:`SparePolicy`
+    over recorded pool samples, for capacity planning.
+
+    Unlike :py:func:`replay`, the pool follows the decisions of every
+    evaluated setting: the recorded demand (busy resources plus queued
+    jobs) is served by the pool each setting would have had, starting
+    with the first recorded size, and every sample is a run of the
+    resizer. Settings other than ``minspare``, ``maxspare`` and
+    ``shrinkfreq`` keep their defaults.
+
+    With NumPy, all the settings are evaluated at once in every sample,
+    and the results are NumPy arrays. Without it, a pure Python loop
+    gives the same results as lists. ::
+
+        settings = list(itertools.product(
+            range(0, 20, 2), range(5, 50, 5), (5, 30, 120)))
+        evaluation = dynpool.evaluate_grid(recorder.columns(), settings)
+
+    :param columns: Mapping with the ``time``, ``size``, ``idle``,
+                    ``qsize``, ``min`` and ``max`` samples as sequences,
+                    like :py:meth:`DecisionRecorder.columns` returns.
+    :param settings: Sequence of ``(minspare, maxspare, shrinkfreq)``.
+    :param numpy: Use NumPy if True, don't if False, and use it if it's
+                  installed if None.
+    :return: A :py:class:`GridEvaluation` with the settings and, for each
+             of them, the seconds of resources used and of jobs queued,
+             the number of grows and shrinks, and the resources grown
+             and shrunk.
+    """
+    if numpy is None or numpy is True:
+        try:
+            import numpy as np
+        except ImportError:
+            if numpy:
+                raise
+            np = None
+    else:
+        np = None
+    settings = [tuple(setting) for setting in settings]
+    times = list(columns['time'])
+    demands = [size - idle + qsize for size, idle, qsize in zip(
+        columns['size'], columns['idle'], columns['qsize'])]
+    samples = list(zip(times, demands, columns['min'], columns['max'],
+                       times[1:] + times[-1:]))
+    start = columns['size'][0] if times else 0
+    if np is None:
+        results = [_evaluate_setting(samples, start, setting)
+                   for setting in settings]
+        return GridEvaluation(settings, *[
+            [result[index] for result in results] for index in range(6)])
+
+    minspare, maxspare, shrinkfreq = np.array(
+        settings, dtype=float).reshape(-1, 3).T
+    minspare = minspare.astype(np.int64)
+    maxspare = maxspare.astype(np.int64)
+    size = np.full(len(settings), start, dtype=np.int64)
+    lastshrink = np.full(len(settings), -np.inf)
+    zeros = np.zeros(len(settings))
+    resource_seconds, queue_seconds = zeros.copy(), zeros.copy()
+    grows, shrinks, grown, shrunk = [
+        zeros.astype(np.int64) for _ in range(4)]
+    for now, demand, pmin, pmax, following in samples:
+        shrinkable = (shrinkfreq > 0) & (now - lastshrink > shrinkfreq)
+        delta = _spare_delta(np, size, demand, pmin, pmax, minspare,
+                             maxspare, shrinkable)
+        lastshrink = np.where(delta < 0, now, lastshrink)
+        grows += delta > 0
+        shrinks += delta < 0
+        grown += np.maximum(delta, 0)
+        shrunk += np.maximum(-delta, 0)
+        size += delta
+        elapsed = following - now
+        resource_seconds += size * elapsed
+        queue_seconds += np.maximum(demand - size, 0) * elapsed
+    return GridEvaluation(settings, resource_seconds, queue_seconds,
+                          grows, shrinks, grown, shrunk)
+
+
+def _evaluate_setting(samples, size, setting):
+    minspare, maxspare, shrinkfreq = setting
+    lastshrink = None
+    resource_seconds = queue_seconds = 0.0
+    grows = shrinks = grown = shrunk = 0
+    for now, demand, pmin, pmax, following in samples:
+        shrinkable = bool(shrinkfreq) and (
+            lastshrink is None or now - lastshrink > shrinkfreq)
+        delta = _spare_delta(_ScalarOps, size, demand, pmin, pmax,
+                             minspare, maxspare, shrinkable)
+        if delta > 0:
+            grows += 1
+            grown += delta
+        elif delta < 0:
+            lastshrink = now
+            shrinks += 1
+            shrunk -= delta
+        size += delta
+        elapsed = following - now
+        resource_seconds += size * elapsed
+        queue_seconds += max(demand - size, 0) * elapsed
+    return resource_seconds, queue_seconds, grows, shrinks, grown, shrunk
+
+
+#
+# Simulation
+#
+
+def poisson_arrivals(rate):
+    """Jobs arriving at a constant average ``rate`` per second."""
+    return _thinned_arrivals(lambda now: rate, rate)
+
+
+def bursty_arrivals(rate, burst_rate, period, length):
+    """Jobs arriving at ``rate`` per second, except during the first
+    ``length`` seconds of every ``period``, when they arrive at
+    ``burst_rate`` per second.
+    """
+    def current_rate(now):
+        return burst_rate if now % period < length else rate
+    return _thinned_arrivals(current_rate, max(rate, burst_rate))
+
+
+def diurnal_arrivals(rate, amplitude, period=86400):
+    """Jobs arriving at ``rate`` per second on average, following a sine
+    wave of relative ``amplitude`` (between 0 and 1) that repeats every
+    ``period`` seconds.
+    """
+    def current_rate(now):
+        return rate * (1 + amplitude * math.sin(2 * math.pi * now / period))
+    return _thinned_arrivals(current_rate, rate * (1 + amplitude))
+
+
+def _thinned_arrivals(current_rate, peak_rate):
+    """
+    Build the arrivals of a Poisson process whose rate changes over time,
+    by thinning a process with the ``peak_rate``.
+    """
+    def arrivals(rng, duration):
+        now = 0.0
+        while peak_rate > 0:
+            now += rng.expovariate(peak_rate)
+            if now > duration:
+                return
+            if rng.random() * peak_rate < current_rate(now):
+                yield now
+    return arrivals
+
+
+def constant_service(seconds):
+    """Jobs that always take ``seconds`` to be handled."""
+    return lambda rng: seconds
+
+
+def exponential_service(mean):
+    """Exponentially distributed service times."""
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal_service(mean, sigma=1):
+    """Log-normally distributed service times, with a long tail of slow
+    jobs that gets longer with ``sigma``.
+    """
+    mu = math.log(mean) - sigma * sigma / 2.0
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class SimulationReport(namedtuple('SimulationReport', [
+        'jobs', 'wait_p50', 'wait_p99', 'wait_max', 'resource_seconds',
+        'grows', 'shrinks', 'grown', 'shrunk'])):
+    """Results of a :py:class:`Simulation`.
+
+    ``jobs`` is the number of jobs that arrived, the ``wait_*`` fields are
+    the seconds jobs waited in the queue (jobs still queued at the end
+    count with the time they had waited so far), ``resource_seconds`` is
+    the sum of the pool size over time, ``grows`` and ``shrinks`` count
+    the calls to ``pool.grow()`` and ``pool.shrink()`` and ``grown`` and
+    ``shrunk`` add up their amounts.
+    """
+    __slots__ = ()
+
+
+class SimulatedPool(object):
+    """Pool used by :py:class:`Simulation`. Follows the
+    :py:class:`PoolInterface` and creates and destroys resources
+    instantly.
+    """
+    def __init__(self, simulation, min=0, max=-1):
+        self.simulation = simulation
+        self.min = min
+        self.max = max
+        self.size = 0
+        self.idle = 0
+        self.queue = deque()
+        self.recent = []
+        self.grows = self.shrinks = self.grown = self.shrunk = 0
+
+    @property
+    def qsize(self):
+        return len(self.queue)
+
+    def grow(self, amount):
+        self.size += amount
+        self.idle += amount
+        self.grows += 1
+        self.grown += amount
+        self.simulation.dispatch()
+
+    def waits(self):
+        recent, self.recent = self.recent, []
+        return recent
+
+    def shrink(self, amount, retire=None):
+        # Simulated resources are all alike, so the hint doesn't matter.
+        amount = min(amount, self.idle)
+        self.size -= amount
+        self.idle -= amount
+        self.shrinks += 1
+        self.shrunk += amount
+
+
+class Simulation(object):
+    """Deterministic discrete event simulation of a pool of resources
+    managed by a resizer, to compare resizing policies and settings
+    without running production traffic.
+
+    :param resizer_factory: Function called as ``resizer_factory(pool,
+                            clock)`` that returns the resizer to test. The
+                            resizer must use ``clock`` as its clock.
+    :param arrivals: Arrival pattern of the jobs, like
+                     :py:func:`poisson_arrivals`,
+                     :py:func:`bursty_arrivals` or
+                     :py:func:`diurnal_arrivals`.
+    :param service: Distribution of the time resources need to handle a
+                    job, like :py:func:`constant_service`,
+                    :py:func:`exponential_service` or
+                    :py:func:`lognormal_service`.
+    :param interval: Seconds between calls to the resizer's ``run()``.
+    :param min: ``min`` value of the simulated pool.
+    :param max: ``max`` value of the simulated pool.
+    :param seed: Seed of the random number generators. The same seed
+                 always gives the same results, and every resizer gets
+                 exactly the same jobs.
+
+    Example
+
+    .. code-block:: python
+
+        simulation = dynpool.Simulation(
+            lambda pool, clock: dynpool.DynamicPoolResizer(
+                pool, minspare=5, maxspare=10, clock=clock),
+            arrivals=dynpool.poisson_arrivals(50),
+            service=dynpool.exponential_service(0.2),
+            min=5, max=100)
+        print(simulation.run(duration=3600))
+    """
+    ARRIVAL, DONE, TICK = range(3)
+
+    def __init__(self, resizer_factory, arrivals, service, interval=1,
+                 min=0, max=-1, seed=0):
+        self.resizer_factory = resizer_factory
+        self.arrivals = arrivals
+        self.service = service
+        self.interval = interval
+        self.min = min
+        self.max = max
+        self.seed = seed
+
+    def clock(self):
+        return self.now
+
+    def run(self, duration):
+        """Simulate ``duration`` seconds and return a
+        :py:class:`SimulationReport`.
+        """
+        self.now = 0.0
+        self.resource_seconds = 0.0
+        arrivals_rng = random.Random(self.seed)
+        service_rng = random.Random(self.seed + 1)
+        self.waits = []
+        self.events = []
+        self._seq = itertools.count()
+        self.pool = pool = SimulatedPool(self, self.min, self.max)
+        self.resizer = self.resizer_factory(pool, self.clock)
+        arrivals = iter(self.arrivals(arrivals_rng, duration))
+        jobs = 0
+
+        self.schedule(0.0, self.TICK)
+        for first in arrivals:
+            self.schedule(first, self.ARRIVAL)
+            break
+        while self.events:
+            when, _, kind = heapq.heappop(self.events)
+            if when > duration:
+                break
+            self.advance(when)
+            if kind == self.ARRIVAL:
+                jobs += 1
+                pool.queue.append((when, self.service(service_rng)))
+                for following in arrivals:
+                    self.schedule(following, self.ARRIVAL)
+                    break
+            elif kind == self.DONE:
+                pool.idle += 1
+            else:
+                self.resizer.run()
+                self.schedule(when + self.interval, self.TICK)
+            self.dispatch()
+        self.advance(duration)
+
+        waits = self.waits + [duration - queued for queued, _ in pool.queue]
+        waits.sort()
+        return SimulationReport(
+            jobs=jobs,
+            wait_p50=_percentile(waits, 50),
+            wait_p99=_percentile(waits, 99),
+            wait_max=waits[-1] if waits else 0.0,
+            resource_seconds=self.resource_seconds,
+            grows=pool.grows, shrinks=pool.shrinks,
+            grown=pool.grown, shrunk=pool.shrunk)
+
+    def schedule(self, when, kind):
+        heapq.heappush(self.events, (when, next(self._seq), kind))
+
+    def advance(self, when):
+        """Move the virtual clock forward, accounting the resources used
+        since the last event.
+        """
+        self.resource_seconds += self.pool.size * (when - self.now)
+        self.now = when
+
+    def dispatch(self):
+        """Hand queued jobs to idle resources."""
+        pool = self.pool
+        while pool.idle and pool.queue:
+            queued, service_time = pool.queue.popleft()
+            pool.idle -= 1
+            self.waits.append(self.now - queued)
+            pool.recent.append(self.now - queued)
+            self.schedule(self.now + service_time, self.DONE)
+
+
+def _percentile(values, percent):
+    """
+    Nearest-rank percentile of a sorted list.
+
+    >>> _percentile([1, 2, 3, 4], 50)
+    2
+    >>> _percentile([], 99)
+    0.0
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+_POLICIES = {
+    'spare': SparePolicy,
+    'predictive': PredictivePolicy,
+    'utilization': TargetUtilizationPolicy,
+}
+
+
+def main(argv=None):
+    """Command line tool to replay decisions dumped by a
+    :py:class:`DecisionRecorder` with different settings::
+
+        python -m dynpool replay decisions.txt --minspare 5 --maxspare 20
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m dynpool')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser(
+        'replay', help='show what other settings would have done')
+    command.add_argument('file', type=argparse.FileType('r'))
+    command.add_argument('--minspare', type=int, required=True)
+    command.add_argument('--maxspare', type=int, required=True)
+    command.add_argument('--shrinkfreq', type=float, default=5)
+    command.add_argument('--policy', choices=sorted(_POLICIES),
+                         default='spare')
+    args = parser.parse_args(argv)
+    if args.command != 'replay':
+        parser.error('a command is required')
+
+    decisions = DecisionRecorder.load(args.file)
+    results = replay(decisions, lambda pool, clock: DynamicPoolResizer(
+        pool, args.minspare, args.maxspare, shrinkfreq=args.shrinkfreq,
+        clock=clock, policy=_POLICIES[args.policy]()))
+    changed = 0
+    for decision, delta in results:
+        mark = ''
+        if delta != decision.delta:
+            changed += 1
+            mark = ' *'
+        print('{0:.3f} size={1} idle={2} queue={3} recorded={4:+d} '
+              'replayed={5:+d}{6}'.format(
+                  decision.time, decision.size, decision.idle,
+                  decision.qsize, decision.delta, delta, mark))
+    print('{0} of {1} decisions changed'.format(changed, len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+dynpool_asyncio
+===============
+
+An :py:mod:`asyncio` version of :py:class:`dynpool.DynamicPoolResizer`,
+for pools of connections or tasks that live in an event loop.
+
+The pool follows the same :py:class:`dynpool.PoolInterface`, but its
+``grow()`` and ``shrink()`` methods can be coroutine functions, so slow
+resource creation (like opening TLS connections) doesn't block the event
+loop. Regular functions are supported too, and so are the optional
+``promote()`` and ``prewarm()`` methods.
+
+Example
+
+.. code-block:: python
+
+    import dynpool_asyncio
+    from example_code import SomeConnectionPool
+
+    async def main():
+        pool = SomeConnectionPool(min=3, max=30)
+        monitor = dynpool_asyncio.AsyncDynamicPoolResizer(
+            pool, minspare=5, maxspare=10)
+
+        # Run the monitor every second in a background task.
+        monitor.start(interval=1)
+        ...
+        await monitor.stop()
+
+This module requires Python 3.7 or later.
+"""
+
+import asyncio
+import inspect
+
+from dynpool import DynamicPoolResizer, _monotonic, _pool_method
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+class AsyncDynamicPoolResizer(DynamicPoolResizer):
+    """Grow or shrink a pool of resources from an asyncio event loop.
+
+    Takes the same parameters as :py:class:`dynpool.DynamicPoolResizer`,
+    but ``mutex`` must be an :py:class:`asyncio.Lock`, which is created in
+    the running event loop by default, and the ``executor`` is ignored
+    since ``grow()`` is awaited instead.
+    """
+    def __init__(self, pool, minspare, maxspare, **kwargs):
+        mutex = kwargs.pop('mutex', None)
+        super().__init__(pool, minspare, maxspare, **kwargs)
+        # An asyncio.Lock created here would belong to the event loop of
+        # this thread on Python < 3.10, and fail in the loop started by
+        # asyncio.run(). Create it in the first run instead.
+        self._mutex = mutex
+        self.executor = None
+        self._task = None
+        self._wakeup = None
+
+    async def run(self):
+        """Perform maintenance operations.
+
+        This coroutine should be awaited periodically by a running
+        application, or run in the background with :py:meth:`start`.
+
+        Return False if the call was skipped because of ``mininterval``,
+        True otherwise.
+        """
+        if self._mutex is None:
+            self._mutex = asyncio.Lock()
+        mininterval = self.mininterval
+        if mininterval is None:
+            async with self._mutex:
+                await self._run(_monotonic())
+            return True
+        last = self._lastrun
+        if self._mutex.locked() or (
+                last is not None and _monotonic() - last < mininterval):
+            return False
+        # Acquiring a free lock doesn't yield to other tasks, so no other
+        # run can start between the check and here.
+        async with self._mutex:
+            started = self._lastrun = _monotonic()
+            await self._run(started)
+        return True
+
+    async def _run(self, started):
+        self._snapshot = self.take_snapshot()
+        try:
+            action, amount = self._decide()
+            if action is not None:
+                await action(amount)
+            amount = self.prewarm_value
+            if amount:
+                await self.prewarm(amount)
+            self._finish_run(started)
+        finally:
+            self._snapshot = None
+
+    async def grow(self, growby):
+        self.action_log('Growing', growby)
+        self._record_action('grow', growby)
+        promote = _pool_method(self.pool, 'promote')
+        if promote is not None:
+            growby -= await _maybe_await(promote(growby)) or 0
+            if growby <= 0:
+                return
+        started = _monotonic()
+        await _maybe_await(self.pool.grow(growby))
+        self._observe_cost('grow', growby, _monotonic() - started)
+
+    async def shrink(self, shrinkby):
+        self.action_log('Shrinking', shrinkby)
+        self._record_action('shrink', shrinkby)
+        started = _monotonic()
+        await _maybe_await(self._pool_shrink(shrinkby))
+        self._observe_cost('shrink', shrinkby, _monotonic() - started)
+
+    async def prewarm(self, amount):
+        self.action_log('Prewarming', amount)
+        await _maybe_await(self.pool.prewarm(amount))
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, interval=1):
+        """Run :py:meth:`run` every ``interval`` seconds in a background
+        task of the running event loop, and return the task.
+
+        Set ``interval`` to None to only run when :py:meth:`wakeup` is
+        called.
+        """
+        if self.running:
+            raise RuntimeError('Pool monitor already running')
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._loop(interval))
+        return self._task
+
+    async def stop(self):
+        """Cancel the background task and wait for it to finish."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def wakeup(self):
+        """Run as soon as possible instead of waiting for the next
+        scheduled tick. Calls made while a run is pending are coalesced.
+        """
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self, interval):
+        loop = asyncio.get_running_loop()
+        wakeup = self._wakeup
+        deadline = loop.time()
+        while True:
+            wakeup.clear()
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.log('Pool monitor: run() failed: {0!r}'.format(exc))
+            if not interval:
+                await wakeup.wait()
+                continue
+            now = loop.time()
+            if now >= deadline:
+                deadline += interval * (int((now - deadline) // interval) + 1)
+            try:
+                await asyncio.wait_for(wakeup.wait(), deadline - now)
+            except asyncio.TimeoutError:
+                pass
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import sys
 from setuptools import setup
 from setuptools.command.test import test
 
@@ -23,6 +24,11 @@ class pytest_test(test):
         pytest.main([])
 
 
+py_modules = ['dynpool']
+if sys.version_info >= (3, 7):
+    py_modules.append('dynpool_asyncio')
+
+
 setup_args = dict(
     name='dynpool',
     version='2.2',
@@ -30,7 +36,7 @@ setup_args = dict(
     author='Gustavo Picon',
     author_email='tabo@tabo.pe',
     license='Apache License 2.0',
-    py_modules=['dynpool'],
+    py_modules=py_modules,
     description='Python library that handles the growing and shrinking '
                 'of a pool of resources depending on usage patterns.',
     long_description=open(root_dir() + '/README').read(),
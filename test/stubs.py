@@ -0,0 +1,9 @@
+class StubPool(object):
+    """Pool whose ``size``, ``idle``, ``qsize``, ``min``, ``max`` and any
+    other attributes are given as keyword arguments. Subclasses keep the
+    amounts they are grown and shrunk by in ``grown`` and ``shrunk``.
+    """
+    def __init__(self, **kwargs):
+        self.grown = []
+        self.shrunk = []
+        self.__dict__.update(kwargs)
@@ -1,6 +1,35 @@
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
 from mock import Mock, patch
 
-from dynpool import DynamicPoolResizer
+from dynpool import (PRESSURE_CRITICAL, PRESSURE_HIGH, PRESSURE_OK,
+                     RETIRE_LARGEST, RETIRE_MOST_USED, RETIRE_OLDEST,
+                     ClassedPool, ClassedResizer, Decision, DecisionRecorder,
+                     DynamicPoolResizer, IdleTracker, LatencySLOPolicy,
+                     PoolCoordinator, PoolMonitor, PoolSnapshot,
+                     PredictivePolicy, ProcessPool, QueueLatencyPolicy,
+                     ResizerMetrics, ResourcePool, SharedStats,
+                     SharedStatsPool, Simulation, SizingProfile, SparePolicy,
+                     StatsdExporter, SystemPressure, TargetUtilizationPolicy,
+                     ThreadPool, bursty_arrivals, constant_service,
+                     diurnal_arrivals, evaluate_grid, exponential_service,
+                     main, poisson_arrivals, replay)
+from stubs import StubPool
+
+
+def _publish_from_child(stats, slot):
+    stats.publish(slot, PoolSnapshot(4, 1, 3, 2, 10))
 
 
 def test_no_threads_and_no_conns_grows_minthreads():
@@ -241,3 +270,1568 @@ def test_run_with_shrink_value_calls_shrink_and_not_grow():
     assert not resizer.grow.called
     assert resizer.can_shrink.called
     resizer.shrink.assert_called_once_with(3)
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+def test_monitor_runs_resizer_periodically():
+    resizer = Mock()
+    monitor = PoolMonitor(resizer, interval=0.01)
+    monitor.start()
+    try:
+        assert _wait_for(lambda: resizer.run.call_count >= 3)
+    finally:
+        monitor.stop()
+    assert not monitor.running
+
+
+def test_monitor_wakeup_runs_before_interval():
+    resizer = Mock()
+    monitor = PoolMonitor(resizer, interval=60)
+    monitor.start()
+    try:
+        assert _wait_for(lambda: resizer.run.call_count == 1)
+        monitor.wakeup()
+        assert _wait_for(lambda: resizer.run.call_count == 2)
+    finally:
+        monitor.stop()
+
+
+def test_monitor_survives_run_errors():
+    logger = Mock()
+    resizer = Mock()
+    resizer.run.side_effect = ValueError('boom')
+    monitor = PoolMonitor(resizer, interval=0.01, logger=logger)
+    monitor.start()
+    try:
+        assert _wait_for(lambda: resizer.run.call_count >= 2)
+    finally:
+        monitor.stop()
+    assert 'boom' in logger.call_args[0][0]
+
+
+def test_monitor_cannot_start_twice():
+    monitor = PoolMonitor(Mock(), interval=60)
+    monitor.start()
+    try:
+        with pytest.raises(RuntimeError):
+            monitor.start()
+    finally:
+        monitor.stop()
+
+
+class SubscribablePool(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+
+def test_monitor_subscribes_to_pool_notifications():
+    resizer = Mock(pool=SubscribablePool())
+    monitor = PoolMonitor(resizer, interval=None)
+    monitor.start()
+    try:
+        assert resizer.pool.callbacks == [monitor.notify]
+    finally:
+        monitor.stop()
+    assert resizer.pool.callbacks == []
+
+
+def test_monitor_without_interval_only_runs_on_notifications():
+    pool = SubscribablePool()
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    resizer.run = Mock()
+    monitor = PoolMonitor(resizer, interval=None)
+    monitor.start()
+    try:
+        assert _wait_for(lambda: resizer.run.call_count == 1)
+        # Steady state, nothing to do.
+        pool.callbacks[0](7, 0)
+        time.sleep(0.05)
+        assert resizer.run.call_count == 1
+        # No idle resources and jobs waiting.
+        pool.callbacks[0](0, 3)
+        assert _wait_for(lambda: resizer.run.call_count == 2)
+    finally:
+        monitor.stop()
+
+
+def test_monitor_debounce_coalesces_notifications():
+    resizer = Mock()
+    monitor = PoolMonitor(resizer, interval=None, debounce=0.1)
+    monitor.start()
+    try:
+        assert _wait_for(lambda: resizer.run.call_count == 1)
+        for _ in range(50):
+            monitor.notify()
+        assert _wait_for(lambda: resizer.run.call_count == 2)
+        time.sleep(0.15)
+        assert resizer.run.call_count == 2
+    finally:
+        monitor.stop()
+
+
+def test_needs_run():
+    resizer = DynamicPoolResizer(Mock(), minspare=5, maxspare=10)
+    assert not resizer.needs_run(7, 0)
+    assert not resizer.needs_run(7, 3)
+    assert resizer.needs_run(0, 3)
+    assert resizer.needs_run(2, 0)
+    assert resizer.needs_run(11, 0)
+
+
+class SnapshotPool(object):
+    def __init__(self, *values):
+        self.values = values
+        self.calls = 0
+
+    def snapshot(self):
+        self.calls += 1
+        return self.values
+
+    def grow(self, amount):
+        pass
+
+    def shrink(self, amount):
+        pass
+
+
+def test_snapshot_reads_pool_attributes():
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=1)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    assert resizer.take_snapshot() == PoolSnapshot(
+        size=10, idle=2, qsize=1, min=5, max=30)
+
+
+def test_snapshot_uses_pool_snapshot_method():
+    pool = SnapshotPool(10, 2, 0, 5, 30)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    snapshot = resizer.take_snapshot()
+    assert isinstance(snapshot, PoolSnapshot)
+    assert snapshot.idle == 2
+    assert resizer.grow_value == 3
+
+
+def test_run_reads_the_pool_once():
+    pool = SnapshotPool(20, 20, 0, 5, 30)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10, logfreq=1,
+                                 logger=Mock())
+    resizer.run()
+    assert pool.calls == 1
+
+
+class SlowGrowPool(StubPool):
+    def __init__(self, **kwargs):
+        super(SlowGrowPool, self).__init__(**kwargs)
+        self.release = threading.Event()
+
+    def grow(self, amount):
+        self.release.wait(2)
+        self.grown.append(amount)
+        self.size += amount
+        self.idle += amount
+
+    def shrink(self, amount):
+        self.shrunk.append(amount)
+
+
+def test_executor_grow_doesnt_block_and_isnt_repeated():
+    pool = SlowGrowPool(min=5, max=30, size=0, idle=0, qsize=0)
+    futures = pytest.importorskip('concurrent.futures')
+    executor = futures.ThreadPoolExecutor(max_workers=2)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 executor=executor)
+    try:
+        resizer.run()
+        assert resizer.inflight == 5
+        assert resizer.grow_value == 0
+        resizer.run()
+        assert resizer.inflight == 5
+        pool.release.set()
+        assert _wait_for(lambda: resizer.inflight == 0)
+    finally:
+        executor.shutdown()
+    assert pool.grown == [5]
+    assert resizer.grow_value == 0
+
+
+def test_executor_grow_resources_being_created_arent_shrunk():
+    pool = SlowGrowPool(min=5, max=30, size=0, idle=0, qsize=10)
+    futures = pytest.importorskip('concurrent.futures')
+    executor = futures.ThreadPoolExecutor(max_workers=2)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 executor=executor, shrinkfreq=0.001)
+    try:
+        resizer.run()
+        assert resizer.inflight == 15
+        # 15 spare resources are more than maxspare, but none exist yet.
+        resizer.lastshrink = None
+        resizer.run()
+        assert resizer.inflight == 15
+        assert resizer.shrink_value == 0
+        pool.release.set()
+        assert _wait_for(lambda: resizer.inflight == 0)
+    finally:
+        executor.shutdown()
+    assert pool.grown == [15]
+    assert pool.shrunk == []
+
+
+class WarmingPool(StubPool):
+    starting = 0
+    standby = 0
+
+    def __init__(self, **kwargs):
+        super(WarmingPool, self).__init__(**kwargs)
+        self.prewarmed = []
+
+    def grow(self, amount):
+        self.grown.append(amount)
+
+    def promote(self, amount):
+        promoted = min(amount, self.standby)
+        self.standby -= promoted
+        return promoted
+
+    def prewarm(self, amount):
+        self.prewarmed.append(amount)
+        self.standby += amount
+
+
+def test_starting_resources_count_as_spare():
+    pool = WarmingPool(min=1, max=30, size=5, idle=0, qsize=0, starting=5)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    assert resizer.pool_snapshot() == PoolSnapshot(5, 5, 0, 1, 30)
+    resizer.run()
+    assert pool.grown == []
+
+
+def test_starting_resources_can_be_instance_attributes():
+    pool = Mock(min=1, max=30, size=5, idle=0, qsize=0, starting=5)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    resizer.run()
+    assert not pool.grow.called
+
+
+def test_starting_resources_arent_shrunk_while_jobs_are_queued():
+    pool = WarmingPool(min=1, max=30, size=10, idle=0, qsize=20,
+                       starting=5)
+    pool.shrink = Mock()
+    resizer = DynamicPoolResizer(pool, minspare=2, maxspare=4)
+    resizer.run()
+    assert pool.grown == []
+    assert not pool.shrink.called
+    # Only the idle resources can go, not the ones that are starting.
+    pool.idle, pool.starting, pool.qsize = 2, 6, 0
+    assert resizer.shrink_value == 2
+
+
+def test_grow_promotes_standby_resources_and_keeps_the_reserve():
+    pool = WarmingPool(min=1, max=30, size=5, idle=0, qsize=4, standby=1)
+    resizer = DynamicPoolResizer(pool, minspare=2, maxspare=4, reserve=3)
+    resizer.run()
+    # One of the 6 resources was promoted, the reserve is refilled after.
+    assert pool.grown == [5]
+    assert pool.prewarmed == [3]
+    pool.standby = 3
+    pool.idle = 3
+    pool.qsize = 0
+    resizer.run()
+    assert pool.prewarmed == [3]
+
+    pool.idle = 0
+    pool.qsize = 1
+    resizer.run()
+    assert pool.grown == [5]
+    assert pool.prewarmed == [3, 3]
+
+
+def test_reserve_is_ignored_without_prewarm():
+    pool = Mock(min=1, max=30, size=5, idle=5, qsize=0)
+    DynamicPoolResizer(pool, minspare=2, maxspare=10, reserve=3).run()
+    assert not pool.prewarm.called
+
+
+def _fake_system(tmpdir, available=50, load='0.50', psi='1.00',
+                 cgroup_max='max', cgroup_current='0', cpu_max='max 100000'):
+    proc = tmpdir.mkdir('proc')
+    proc.join('meminfo').write(
+        'MemTotal:  100 kB\nMemFree:  10 kB\n'
+        'MemAvailable:  {0} kB\n'.format(available))
+    proc.join('loadavg').write('{0} 0.40 0.30 1/100 1234\n'.format(load))
+    proc.mkdir('pressure').join('cpu').write(
+        'some avg10={0} avg60=0.00 avg300=0.00 total=1\n'
+        'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n'.format(psi))
+    cgroup = tmpdir.mkdir('cgroup')
+    cgroup.join('memory.max').write(cgroup_max + '\n')
+    cgroup.join('memory.current').write(cgroup_current + '\n')
+    cgroup.join('memory.stat').write('anon 10\ninactive_file 100\n')
+    cgroup.join('cpu.max').write(cpu_max + '\n')
+    return str(proc), str(cgroup)
+
+
+def test_system_pressure_reads_proc_and_cgroup(tmpdir):
+    proc, cgroup = _fake_system(tmpdir, cgroup_max='1000',
+                                cgroup_current='900', cpu_max='50000 100000')
+    pressure = SystemPressure(load=(1, 2), psi=(10, 20), proc=proc,
+                              cgroup=cgroup)
+    free, load, psi = pressure.read()
+    # 800 bytes used in the cgroup, once the page cache is discounted.
+    assert free == pytest.approx(0.2)
+    # Half a CPU.
+    assert load == pytest.approx(1.0)
+    assert psi == 1.0
+    assert pressure.level() == PRESSURE_OK
+
+
+def test_system_pressure_levels_and_missing_files(tmpdir):
+    proc, cgroup = _fake_system(tmpdir, available=8)
+    pressure = SystemPressure(interval=0, proc=proc, cgroup=cgroup)
+    assert pressure.level() == PRESSURE_HIGH
+    tmpdir.join('proc', 'meminfo').write(
+        'MemTotal: 100 kB\nMemAvailable: 4 kB\n')
+    assert pressure.level() == PRESSURE_CRITICAL
+
+    nothing = SystemPressure(load=(1, 2), psi=(10, 20),
+                             proc=str(tmpdir.join('none')),
+                             cgroup=str(tmpdir.join('none')))
+    assert nothing.read() == (None, None, None)
+    assert nothing.level() == PRESSURE_OK
+
+
+def test_system_pressure_is_cached(tmpdir):
+    proc, cgroup = _fake_system(tmpdir, available=8)
+    pressure = SystemPressure(interval=60, proc=proc, cgroup=cgroup)
+    assert pressure.level() == PRESSURE_HIGH
+    tmpdir.join('proc', 'meminfo').write(
+        'MemTotal: 100 kB\nMemAvailable: 50 kB\n')
+    assert pressure.level() == PRESSURE_HIGH
+
+
+def test_pressure_limits_growth_and_sheds_idle_resources():
+    pressure = Mock()
+    pressure.level.return_value = PRESSURE_HIGH
+    pool = Mock(min=2, max=30, size=0, idle=0, qsize=10)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 pressure=pressure)
+    resizer.run()
+    pool.grow.assert_called_once_with(2)
+    pool.size = 2
+    resizer.run()
+    assert pool.grow.call_count == 1
+    assert not pool.shrink.called
+
+    pressure.level.return_value = PRESSURE_CRITICAL
+    pool.size = pool.idle = 9
+    pool.qsize = 0
+    resizer.run()
+    pool.shrink.assert_called_once_with(5)
+
+
+def test_sizing_profile_learns_and_persists_peaks(tmpdir):
+    path = str(tmpdir.join('profile.json'))
+    hour = 3600
+    profile = SizingProfile(path, buckets=24)
+    profile.observe(10 * hour, PoolSnapshot(10, 4, 0, 1, -1))
+    profile.observe(10 * hour + 5, PoolSnapshot(10, 0, 6, 1, -1))
+    profile.observe(11 * hour, PoolSnapshot(10, 5, 0, 1, -1))
+    profile.save(11 * hour + 10)
+    assert tmpdir.listdir() == [tmpdir.join('profile.json')]
+
+    restarted = SizingProfile(path, buckets=24)
+    assert restarted.expected(10 * hour + 100) == 16
+    # The peak of the last bucket counts until the bucket is over.
+    assert restarted.expected(11 * hour + 20) == 5
+    assert restarted.expected(35 * hour) == 0
+
+    # The next day the peaks are averaged.
+    restarted.observe(34 * hour, PoolSnapshot(4, 0, 0, 1, -1))
+    restarted.observe(35 * hour, PoolSnapshot(4, 0, 0, 1, -1))
+    assert restarted.expected(34 * hour) == 10
+
+
+def test_sizing_profile_ignores_unreadable_files(tmpdir):
+    path = tmpdir.join('profile.json')
+    path.write('{"version": 1, "peaks": [')
+    assert SizingProfile(str(path)).peaks == [None] * 48
+    path.write('{"version": 1, "period": 60, "peaks": []}')
+    assert SizingProfile(str(path)).peaks == [None] * 48
+
+
+@pytest.mark.parametrize('data', [
+    {'peaks': [1, None]},
+    {'peaks': 2},
+    {'peaks': [1, 'a'], 'bucket': 0, 'current': 0, 'saved': 1},
+    {'peaks': [1, None], 'bucket': 2, 'current': 0, 'saved': 1},
+    {'peaks': [1, None], 'bucket': 0, 'current': None, 'saved': 1},
+    {'peaks': [1, None], 'bucket': 0, 'current': 0, 'saved': '1'},
+])
+def test_sizing_profile_ignores_incomplete_files(tmpdir, data):
+    path = tmpdir.join('profile.json')
+    data.update(version=1, period=86400)
+    path.write(json.dumps(data))
+    profile = SizingProfile(str(path), buckets=2)
+    assert profile.peaks == [None, None]
+    assert profile.bucket is None
+    data.update(peaks=[1, None], bucket=0, current=3, saved=1)
+    path.write(json.dumps(data))
+    assert SizingProfile(str(path), buckets=2).current == 3
+
+
+def test_resizer_warms_up_from_profile(tmpdir):
+    profile = SizingProfile(str(tmpdir.join('profile.json')), buckets=1,
+                            warmup=300)
+    profile.peaks = [20]
+    now = [1000]
+    pool = Mock(min=1, max=100, size=0, idle=0, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 clock=lambda: now[0], profile=profile)
+    resizer.run()
+    pool.grow.assert_called_once_with(25)
+
+    # Half way through the warm up, keep half of it.
+    now[0] += 150
+    pool.size = pool.idle = 25
+    resizer.run()
+    pool.shrink.assert_called_once_with(12)
+
+    now[0] += 300
+    pool.size = pool.idle = 13
+    resizer.run()
+    pool.shrink.assert_called_with(8)
+
+
+def test_executor_grow_failure_is_logged():
+    pool = Mock()
+    pool.grow.side_effect = OSError('too many open files')
+    logger = Mock()
+    futures = pytest.importorskip('concurrent.futures')
+    executor = futures.ThreadPoolExecutor(max_workers=1)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 logger=logger, executor=executor)
+    resizer.grow(3)
+    executor.shutdown()
+    assert resizer.inflight == 0
+    assert 'too many open files' in logger.call_args[0][0]
+
+
+def test_default_policy_is_spare_policy():
+    resizer = DynamicPoolResizer(Mock(), minspare=5, maxspare=10)
+    assert isinstance(resizer.policy, SparePolicy)
+
+
+def test_predictive_policy_without_history_acts_like_spare_policy():
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 policy=PredictivePolicy())
+    assert resizer.grow_value == 3
+    pool.idle = 10
+    assert resizer.shrink_value == 5
+
+
+def test_predictive_policy_grows_ahead_of_rising_demand():
+    policy = PredictivePolicy(alpha=1, horizon=2)
+    pool = Mock(min=5, max=30, size=12, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 policy=policy)
+    policy.observe(resizer, resizer.take_snapshot(), 0)
+    pool.idle = 5
+    policy.observe(resizer, resizer.take_snapshot(), 1)
+    # The demand grew from 5 to 7 busy resources in a second, the spare
+    # policy is still satisfied but in two seconds we'll need 4 more.
+    assert policy.rate == 2
+    assert SparePolicy().grow_value(resizer, resizer.take_snapshot()) == 0
+    assert resizer.grow_value == 4
+    assert resizer.shrink_value == 0
+
+
+def test_predictive_policy_respects_max():
+    policy = PredictivePolicy(alpha=1, horizon=10)
+    pool = Mock(min=5, max=15, size=12, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 policy=policy)
+    policy.observe(resizer, resizer.take_snapshot(), 0)
+    pool.idle = 5
+    policy.observe(resizer, resizer.take_snapshot(), 1)
+    assert resizer.grow_value == 3
+
+
+def test_run_feeds_the_policy():
+    policy = Mock()
+    policy.grow_value.return_value = 0
+    policy.shrink_value.return_value = 0
+    pool = Mock(min=5, max=30, size=10, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 policy=policy)
+    resizer.run()
+    assert policy.observe.call_args[0][1] == resizer.take_snapshot()
+
+
+def test_spare_policy_delta():
+    policy = SparePolicy()
+    resizer = DynamicPoolResizer(Mock(), minspare=5, maxspare=10)
+    grow = PoolSnapshot(size=10, idle=2, qsize=0, min=5, max=30)
+    shrink = PoolSnapshot(size=20, idle=20, qsize=0, min=5, max=30)
+    steady = PoolSnapshot(size=20, idle=5, qsize=0, min=5, max=30)
+    assert policy.delta(resizer, grow, []) == 3
+    assert policy.delta(resizer, shrink, []) == -15
+    assert policy.delta(resizer, steady, []) == 0
+
+
+def test_target_utilization_policy_grows_to_target():
+    pool = Mock(min=2, max=100, size=10, idle=0, qsize=4)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 policy=TargetUtilizationPolicy(0.7))
+    # 14 jobs at 70% utilisation need 20 resources.
+    assert resizer.grow_value == 10
+    assert resizer.shrink_value == 0
+
+
+def test_target_utilization_policy_shrinks_to_peak_in_history():
+    pool = Mock(min=2, max=100, size=20, idle=13, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 policy=TargetUtilizationPolicy(0.5))
+    assert resizer.shrink_value == 6
+    resizer.history.append(
+        (0, PoolSnapshot(size=20, idle=11, qsize=0, min=2, max=100)))
+    assert resizer.shrink_value == 2
+    assert resizer.grow_value == 0
+
+
+def test_target_utilization_policy_grows_to_min():
+    pool = Mock(min=5, max=100, size=0, idle=0, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 policy=TargetUtilizationPolicy(0.7))
+    resizer.run()
+    pool.grow.assert_called_once_with(5)
+
+
+def test_queue_latency_policy():
+    pool = Mock(min=2, max=100, size=10, idle=0, qsize=30)
+    resizer = DynamicPoolResizer(
+        pool, minspare=0, maxspare=0,
+        policy=QueueLatencyPolicy(target=0.5, service_time=0.25))
+    # 30 jobs * 0.25s / 0.5s = 15 resources.
+    assert resizer.grow_value == 5
+    pool.qsize = 0
+    pool.idle = 6
+    assert resizer.grow_value == 0
+    assert resizer.shrink_value == 6
+
+
+def test_queue_latency_policy_grows_to_min():
+    pool = Mock(min=5, max=100, size=0, idle=0, qsize=0)
+    resizer = DynamicPoolResizer(
+        pool, minspare=0, maxspare=0,
+        policy=QueueLatencyPolicy(target=0.5, service_time=0.25))
+    resizer.run()
+    pool.grow.assert_called_once_with(5)
+
+
+class WaitsPool(StubPool):
+    def __init__(self, **kwargs):
+        super(WaitsPool, self).__init__(**kwargs)
+        self.pending = []
+
+    def waits(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def grow(self, amount):
+        self.size += amount
+        self.idle += amount
+
+    def shrink(self, amount):
+        self.size -= amount
+        self.idle -= amount
+
+
+def test_latency_slo_policy_grows_and_doesnt_wind_up():
+    now = [0]
+    pool = WaitsPool(min=1, max=12, size=10, idle=0, qsize=0)
+    policy = LatencySLOPolicy(target=0.1)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 clock=lambda: now[0], policy=policy)
+    pool.pending = [0.3] * 20
+    resizer.run()
+    assert policy.wait == 0.3
+    assert pool.size == 12
+
+    # The pool is at its maximum, the integral stops there.
+    now[0] = 10
+    pool.idle = 0
+    pool.pending = [0.3] * 20
+    resizer.run()
+    assert policy.integral == 12
+
+    # So it shrinks as soon as the waits are under the target.
+    now[0] = 20
+    pool.idle = 6
+    pool.pending = [0.0] * 20
+    resizer.run()
+    assert pool.size == 6
+
+
+def test_latency_slo_policy_doesnt_wind_up_while_the_ramp_limits_it():
+    now = [0]
+    pool = WaitsPool(min=1, max=-1, size=10, idle=0, qsize=0)
+    policy = LatencySLOPolicy(target=0.1)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0, maxgrow=1,
+                                 shrinkfreq=0.5, clock=lambda: now[0],
+                                 policy=policy)
+    for now[0] in range(60):
+        pool.idle = 0
+        pool.pending = [0.3] * 20
+        resizer.run()
+    assert pool.size == 70
+    assert policy.integral <= pool.size
+
+    # Once the waits are under the target, the pool shrinks right away.
+    now[0] += 1
+    pool.idle = pool.size - 15
+    pool.pending = [0.0] * 20
+    resizer.run()
+    assert pool.size < 70
+
+
+def test_latency_slo_policy_grows_for_queued_jobs():
+    pool = WaitsPool(min=1, max=-1, size=4, idle=0, qsize=6)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 policy=LatencySLOPolicy(target=0.1))
+    resizer.run()
+    assert pool.size == 10
+
+
+def test_latency_slo_policy_needs_waits():
+    pool = Mock(min=1, max=10, size=5, idle=5, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=0, maxspare=0,
+                                 policy=LatencySLOPolicy(target=0.1))
+    with pytest.raises(TypeError):
+        resizer.run()
+
+
+def test_nonblocking_run_skips_recent_runs():
+    pool = Mock(min=1, max=30, size=10, idle=6, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 mininterval=1, historylen=10)
+    with patch('dynpool._monotonic', return_value=100):
+        assert resizer.run()
+        assert not resizer.run()
+    with patch('dynpool._monotonic', return_value=101):
+        assert resizer.run()
+    assert len(resizer.history) == 2
+
+
+def test_nonblocking_run_skips_concurrent_runs():
+    pool = Mock(min=1, max=30, size=10, idle=6, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 mininterval=0)
+    with resizer._mutex:
+        assert not resizer.run()
+    assert resizer.run()
+    assert resizer.run()
+
+
+def test_run_records_history():
+    pool = Mock(min=5, max=30, size=10, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 historylen=2)
+    for _ in range(3):
+        resizer.run()
+    assert len(resizer.history) == 2
+    assert resizer.history[-1][1] == resizer.take_snapshot()
+
+
+def _simulation(**kwargs):
+    params = dict(
+        resizer_factory=lambda pool, clock: DynamicPoolResizer(
+            pool, minspare=2, maxspare=4, clock=clock),
+        arrivals=poisson_arrivals(10),
+        service=exponential_service(0.2),
+        min=2, max=20)
+    params.update(kwargs)
+    return Simulation(**params)
+
+
+class DemandPool(object):
+    """Pool that serves a given demand with the resources it has."""
+    def __init__(self, size, min, max):
+        self.size = size
+        self.min = min
+        self.max = max
+        self.demand = 0
+
+    idle = property(lambda self: self.size - min(self.demand, self.size))
+    qsize = property(lambda self: self.demand - min(self.demand, self.size))
+
+    def grow(self, amount):
+        self.size += amount
+
+    def shrink(self, amount):
+        self.size -= amount
+
+
+def _recorded_samples(count=400):
+    rng = random.Random(3)
+    decisions = []
+    demand = 5
+    for second in range(count):
+        demand = max(0, demand + rng.randint(-4, 4))
+        busy = min(demand, 12)
+        decisions.append((second * 2.0, 12, 12 - busy, demand - busy, 2, 40))
+    return dict(zip(('time', 'size', 'idle', 'qsize', 'min', 'max'),
+                    zip(*decisions)))
+
+
+def _evaluate_with_resizer(columns, minspare, maxspare, shrinkfreq):
+    now = [0]
+    pool = DemandPool(columns['size'][0], min=2, max=40)
+    resizer = DynamicPoolResizer(pool, minspare, maxspare,
+                                 shrinkfreq=shrinkfreq, clock=lambda: now[0])
+    times = columns['time']
+    resource_seconds = queue_seconds = 0
+    for index, when in enumerate(times):
+        now[0] = when
+        pool.demand = (columns['size'][index] - columns['idle'][index] +
+                       columns['qsize'][index])
+        resizer.run()
+        elapsed = times[min(index + 1, len(times) - 1)] - when
+        resource_seconds += pool.size * elapsed
+        queue_seconds += pool.qsize * elapsed
+    return resource_seconds, queue_seconds
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_evaluate_grid_matches_the_resizer(use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    columns = _recorded_samples()
+    settings = list(itertools.product((0, 3), (4, 10), (0, 5)))
+    evaluation = evaluate_grid(columns, settings, numpy=use_numpy)
+    assert evaluation.settings == settings
+    for index, setting in enumerate(settings):
+        assert _evaluate_with_resizer(columns, *setting) == (
+            evaluation.resource_seconds[index],
+            evaluation.queue_seconds[index])
+    # Without shrinkfreq the pool never shrinks.
+    assert evaluation.shrinks[0] == 0
+    assert evaluation.shrinks[1] > 0
+    assert evaluation.grows[0] > 0
+
+
+def test_recorder_columns_feed_evaluate_grid():
+    recorder = DecisionRecorder(capacity=3)
+    for second in range(5):
+        recorder.record(second, PoolSnapshot(4, second, 0, 1, 10), 0, 0, 0)
+    columns = recorder.columns()
+    assert list(columns['time']) == [2, 3, 4]
+    assert list(columns['idle']) == [2, 3, 4]
+    evaluation = evaluate_grid(columns, [(1, 2, 0)], numpy=False)
+    assert evaluation.resource_seconds == [8.0]
+
+
+def test_simulation_is_deterministic():
+    assert _simulation().run(300) == _simulation().run(300)
+    assert _simulation().run(300) != _simulation(seed=1).run(300)
+
+
+def test_simulation_gives_every_policy_the_same_jobs():
+    predictive = _simulation(
+        resizer_factory=lambda pool, clock: DynamicPoolResizer(
+            pool, minspare=2, maxspare=4, clock=clock,
+            policy=PredictivePolicy()))
+    assert predictive.run(300).jobs == _simulation().run(300).jobs
+
+
+def test_simulation_accounts_resource_seconds():
+    report = _simulation(arrivals=poisson_arrivals(0), min=3).run(100)
+    assert report.jobs == 0
+    assert report.resource_seconds == 300
+    assert report.grows == 1
+    assert report.grown == 3
+
+
+def test_simulation_accepts_retire_hints():
+    report = _simulation(resizer_factory=lambda pool, clock: (
+        DynamicPoolResizer(pool, minspare=2, maxspare=4, clock=clock,
+                           retire=RETIRE_OLDEST))).run(300)
+    assert report.shrinks > 0
+
+
+def test_simulation_reports_queue_waits():
+    report = _simulation(arrivals=poisson_arrivals(20),
+                         service=constant_service(1), min=1, max=1).run(60)
+    assert report.jobs > 60
+    assert report.wait_p50 > 0
+    assert report.wait_p99 > report.wait_p50
+
+
+def test_simulation_latency_slo_policy_meets_target_with_less_resources():
+    slo = _simulation(
+        resizer_factory=lambda pool, clock: DynamicPoolResizer(
+            pool, minspare=2, maxspare=4, clock=clock,
+            policy=LatencySLOPolicy(target=0.1)))
+    report = slo.run(600)
+    waits = sorted(slo.waits)
+    assert waits[int(len(waits) * 0.95)] <= 0.1
+    assert report.resource_seconds < _simulation().run(600).resource_seconds
+
+
+def test_simulation_arrival_patterns():
+    rng = random.Random(0)
+    bursts = list(bursty_arrivals(0, 100, period=10, length=1)(rng, 30))
+    assert bursts
+    assert all(when % 10 < 1 for when in bursts)
+    diurnal = list(diurnal_arrivals(10, 1, period=100)(rng, 100))
+    # About 82% of the jobs arrive in the first half of the period.
+    assert sum(1 for when in diurnal if when < 50) > 0.75 * len(diurnal)
+
+
+def test_grow_cooldown():
+    growfreq = 3
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 growfreq=growfreq)
+    assert resizer.can_grow() is True
+    resizer.run()
+    pool.grow.assert_called_once_with(3)
+    resizer.run()
+    assert pool.grow.call_count == 1
+    resizer.lastgrow -= growfreq + 1
+    resizer.run()
+    assert pool.grow.call_count == 2
+
+
+def test_shrink_after_sustained_idle():
+    pool = Mock(min=5, max=30, size=20, idle=20, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 shrinkfreq=1, shrinkafter=3)
+    resizer.run()
+    resizer.run()
+    assert not pool.shrink.called
+    resizer.run()
+    pool.shrink.assert_called_once_with(15)
+    assert resizer.shrinkruns == 0
+
+
+def test_shrink_after_is_reset_by_load():
+    pool = Mock(min=5, max=30, size=20, idle=20, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 shrinkfreq=1, shrinkafter=2)
+    resizer.run()
+    pool.idle, pool.qsize = 7, 1
+    resizer.run()
+    pool.idle, pool.qsize = 20, 0
+    resizer.run()
+    assert not pool.shrink.called
+    resizer.run()
+    assert pool.shrink.called
+
+
+def test_churn_counts_direction_changes():
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 shrinkfreq=1)
+    resizer.run()
+    resizer.run()
+    assert resizer.churn == 0
+    pool.idle = 10
+    resizer.run()
+    assert resizer.churn == 1
+    pool.idle = 2
+    resizer.run()
+    assert resizer.churn == 2
+
+
+def test_metrics_record_runs_and_actions():
+    metrics = ResizerMetrics()
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 metrics=metrics)
+    resizer.run()
+    assert (metrics.runs, metrics.grows, metrics.grown) == (1, 1, 3)
+    assert (metrics.size, metrics.idle, metrics.qsize) == (10, 2, 0)
+    assert metrics.run_seconds.count == 1
+
+
+def test_metrics_pressure_histogram():
+    metrics = ResizerMetrics(pressure_buckets=(1, 5))
+    metrics.observe_run(PoolSnapshot(5, 0, 3, 1, 10), 0, 0, 10)
+    metrics.observe_run(PoolSnapshot(8, 0, 1, 1, 10), 0, 0, 11)
+    assert metrics.pressure_seconds.count == 0
+    metrics.observe_run(PoolSnapshot(8, 2, 0, 1, 10), 0, 0, 13)
+    assert metrics.pressure_seconds.cumulative() == [
+        (1, 0), (5, 1), (float('inf'), 1)]
+    assert metrics.pressure_seconds.sum == 3
+
+
+def test_metrics_prometheus_format():
+    metrics = ResizerMetrics(run_buckets=(0.5,))
+    metrics.observe_action('shrink', 4)
+    metrics.run_seconds.observe(0.25)
+    text = metrics.prometheus(labels={'pool': 'db'})
+    assert '# TYPE dynpool_shrunk_total counter\n' in text
+    assert 'dynpool_shrunk_total{pool="db"} 4\n' in text
+    assert 'dynpool_run_seconds_bucket{pool="db",le="0.5"} 1\n' in text
+    assert 'dynpool_run_seconds_bucket{pool="db",le="+Inf"} 1\n' in text
+    assert 'dynpool_run_seconds_count{pool="db"} 1\n' in text
+    assert 'dynpool_idle 0\n' in metrics.prometheus()
+
+
+def test_resizer_times_pool_calls():
+    pool = Mock(min=1, max=30, size=0, idle=0, qsize=0)
+    metrics = ResizerMetrics()
+    resizer = DynamicPoolResizer(pool, minspare=2, maxspare=4,
+                                 metrics=metrics)
+    with patch('dynpool._monotonic', side_effect=[0, 4, 10, 11]):
+        resizer.grow(2)
+        resizer.shrink(1)
+    assert resizer.growcost == 2
+    assert resizer.shrinkcost == 1
+    assert metrics.grow_seconds.sum == 4
+    assert metrics.shrink_seconds.count == 1
+    with patch('dynpool._monotonic', side_effect=[0, 1]):
+        resizer.grow(1)
+    assert resizer.growcost == pytest.approx(1.7)
+    # Only used with costaware.
+    assert resizer.costfactor == 1
+
+
+def test_costaware_resizer_holds_expensive_resources():
+    now = [0]
+    pool = Mock(min=1, max=30, size=20, idle=9, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=2, maxspare=10,
+                                 clock=lambda: now[0], costaware=True)
+    assert resizer.shrink_value == 4
+    resizer.growcost = 1.0
+    assert resizer.costfactor == 4
+    assert resizer.shrink_value == 1
+    resizer.run()
+    now[0] = 10
+    resizer.run()
+    now[0] = 21
+    resizer.run()
+    assert pool.shrink.call_count == 2
+
+    resizer.growcost = 0.0001
+    assert resizer.costfactor == 0.25
+    # Down to one more than minspare right away.
+    assert resizer.shrink_value == 6
+
+
+def test_statsd_exporter_sends_increments():
+    metrics = ResizerMetrics()
+    exporter = StatsdExporter(metrics, prefix='pool')
+    metrics.observe_action('grow', 3)
+    assert 'pool.grown:3|c' in exporter.lines()
+    metrics.observe_action('grow', 2)
+    lines = exporter.lines()
+    assert 'pool.grown:2|c' in lines
+    assert 'pool.size:0|g' in lines
+    assert not [line for line in exporter.lines() if line.endswith('|c')]
+
+
+def test_statsd_exporter_sends_datagram():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(2)
+    try:
+        metrics = ResizerMetrics()
+        metrics.observe_action('grow', 3)
+        StatsdExporter(metrics, address=receiver.getsockname()).send()
+        payload = receiver.recv(65536).decode('ascii')
+    finally:
+        receiver.close()
+    assert 'dynpool.grown:3|c' in payload.split('\n')
+
+
+def test_log_suppresses_repeated_states():
+    logger = Mock()
+    pool = Mock(min=5, max=30, size=10, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 logger=logger)
+    resizer.queue_log()
+    resizer.queue_log()
+    logger.assert_called_once_with(
+        'Thread pool: [current=10/idle=7/queue=0]')
+    pool.qsize = 1
+    resizer.queue_log()
+    assert logger.call_count == 2
+
+
+def test_log_suppression_is_per_resizer():
+    logger = Mock()
+    pool = Mock(min=5, max=30, size=10, idle=7, qsize=0)
+    first = DynamicPoolResizer(pool, minspare=5, maxspare=10, logger=logger)
+    second = DynamicPoolResizer(pool, minspare=5, maxspare=10, logger=logger)
+    for _ in range(3):
+        first.queue_log()
+        second.queue_log()
+    assert logger.call_count == 2
+
+
+def test_action_log_message():
+    logger = Mock()
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 logger=logger)
+    resizer.grow(3)
+    logger.assert_called_once_with(
+        'Thread pool: [current=10/idle=2/queue=0] Growing by 3')
+
+
+def test_no_logger_doesnt_read_the_pool():
+    pool = Mock(min=5, max=30, size=10, idle=7, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    resizer.take_snapshot = Mock()
+    resizer.queue_log()
+    resizer.action_log('Growing', 3)
+    assert not resizer.take_snapshot.called
+
+
+def test_coordinator_runs_every_resizer():
+    first = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    second = Mock(min=5, max=30, size=20, idle=20, qsize=0)
+    coordinator = PoolCoordinator()
+    coordinator.add(DynamicPoolResizer(first, minspare=5, maxspare=10))
+    coordinator.add(DynamicPoolResizer(second, minspare=5, maxspare=10))
+    coordinator.run()
+    first.grow.assert_called_once_with(3)
+    second.shrink.assert_called_once_with(15)
+
+
+def test_coordinator_gives_budget_to_the_busiest_pool_first():
+    calm = Mock(min=0, max=100, size=10, idle=0, qsize=2)
+    busy = Mock(min=0, max=100, size=10, idle=0, qsize=20)
+    coordinator = PoolCoordinator(budget=40)
+    coordinator.add(DynamicPoolResizer(calm, minspare=5, maxspare=10))
+    coordinator.add(DynamicPoolResizer(busy, minspare=5, maxspare=10))
+    coordinator.run()
+    busy.grow.assert_called_once_with(20)
+    assert not calm.grow.called
+
+
+def test_coordinator_budget_uses_costs_and_shrinks():
+    cheap = Mock(min=0, max=100, size=10, idle=0, qsize=5)
+    expensive = Mock(min=0, max=100, size=5, idle=0, qsize=10)
+    idle = Mock(min=0, max=100, size=10, idle=10, qsize=0)
+    coordinator = PoolCoordinator(budget=45)
+    coordinator.add(DynamicPoolResizer(cheap, minspare=5, maxspare=10))
+    coordinator.add(DynamicPoolResizer(expensive, minspare=5, maxspare=10),
+                    cost=2)
+    coordinator.add(DynamicPoolResizer(idle, minspare=5, maxspare=10))
+    # 10 + 2 * 5 + 10 = 30 used, 5 more freed by the shrink.
+    coordinator.run()
+    idle.shrink.assert_called_once_with(5)
+    expensive.grow.assert_called_once_with(10)
+    assert not cheap.grow.called
+
+
+def test_coordinator_doesnt_ramp_up_grows_that_arent_granted():
+    recorder = DecisionRecorder()
+    resizers = []
+    coordinator = PoolCoordinator(budget=20)
+    for _ in range(2):
+        pool = Mock(min=0, max=100, size=10, idle=0, qsize=40)
+        resizers.append(coordinator.add(DynamicPoolResizer(
+            pool, minspare=5, maxspare=10, slowstart=4, recorder=recorder)))
+    coordinator.run()
+    for resizer in resizers:
+        assert not resizer.pool.grow.called
+        assert resizer.rampstep == 0
+        assert resizer.lastaction is None
+        assert resizer.growdebt == 45
+    assert [decision.delta for decision in recorder] == [0, 0]
+    resizers[1].pool.size = 6
+    coordinator.run()
+    resizers[1].pool.grow.assert_called_once_with(4)
+    assert resizers[1].rampstep == 8
+    assert resizers[1].lastaction == 'grow'
+    assert resizers[1].growdebt == 41
+    assert [decision.delta for decision in recorder][2:] == [4, 0]
+
+
+def test_coordinator_errors_dont_stop_the_other_pools():
+    logger = Mock()
+    broken = Mock(min=1, max=10, size=5, idle=5, qsize=0)
+    failing = Mock(min=0, max=100, size=10, idle=0, qsize=20)
+    failing.grow.side_effect = OSError('too many open files')
+    busy = Mock(min=0, max=100, size=10, idle=0, qsize=5)
+    coordinator = PoolCoordinator()
+    coordinator.add(DynamicPoolResizer(
+        broken, minspare=0, maxspare=0, logger=logger,
+        policy=LatencySLOPolicy(target=0.1)))
+    coordinator.add(DynamicPoolResizer(failing, minspare=5, maxspare=10,
+                                       logger=logger))
+    coordinator.add(DynamicPoolResizer(busy, minspare=5, maxspare=10))
+    coordinator.run()
+    busy.grow.assert_called_once_with(10)
+    errors = [call[0][0] for call in logger.call_args_list
+              if 'failed' in call[0][0]]
+    assert len(errors) == 2
+    assert 'TypeError' in errors[0] and 'OSError' in errors[1]
+    assert all(resizer._proposal is None
+               for resizer, _ in coordinator.resizers)
+
+
+def test_coordinator_remove():
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10)
+    coordinator = PoolCoordinator()
+    coordinator.add(resizer)
+    coordinator.remove(resizer)
+    coordinator.run()
+    assert not pool.grow.called
+
+
+def test_classed_resizer_grows_the_class_that_backs_up():
+    small = Mock(min=1, max=30, size=4, idle=0, qsize=6)
+    large = Mock(min=0, max=4, size=1, idle=1, qsize=0)
+    resizer = ClassedResizer(
+        ClassedPool([('small', small), ('large', large)]), shrinkfreq=0,
+        settings={'small': dict(minspare=2, maxspare=4),
+                  'large': dict(minspare=1, maxspare=1, cost=8)})
+    assert resizer.classes['large'].minspare == 1
+    assert resizer.classes['small'].shrinkfreq == 0
+    resizer.run()
+    small.grow.assert_called_once_with(8)
+    assert not large.grow.called
+
+
+def test_classed_resizer_shares_the_budget():
+    small = Mock(min=0, max=-1, size=0, idle=0, qsize=4)
+    large = Mock(min=0, max=-1, size=0, idle=0, qsize=4)
+    resizer = ClassedResizer(
+        {'small': small, 'large': large}, budget=16, minspare=0, maxspare=2,
+        settings={'large': dict(cost=8)})
+    resizer.run()
+    # 4 small resources, and 12 units left for a single large one.
+    small.grow.assert_called_once_with(4)
+    large.grow.assert_called_once_with(1)
+
+
+def test_classed_pool_adds_up_its_classes():
+    small = Mock(min=1, max=30, size=4, idle=0, qsize=6)
+    large = Mock(min=0, max=-1, size=2, idle=2, qsize=0)
+    pool = ClassedPool([('small', small), ('large', large)])
+    assert pool.snapshot() == PoolSnapshot(6, 2, 6, 1, -1)
+    assert list(pool.classes()) == ['small', 'large']
+    pool.grow(3)
+    small.grow.assert_called_once_with(3)
+    pool.shrink(1)
+    large.shrink.assert_called_once_with(1)
+
+
+def test_classed_pool_grows_classes_within_their_max():
+    a = Mock(min=0, max=4, size=3, idle=0, qsize=6)
+    b = Mock(min=0, max=10, size=2, idle=0, qsize=1)
+    c = Mock(min=0, max=-1, size=0, idle=0, qsize=0)
+    pool = ClassedPool([('a', a), ('b', b), ('c', c)])
+    pool.grow(12)
+    a.grow.assert_called_once_with(1)
+    b.grow.assert_called_once_with(8)
+    c.grow.assert_called_once_with(3)
+
+
+def test_classed_pool_shrinks_classes_within_their_min():
+    a = Mock(min=3, max=10, size=4, idle=4, qsize=0)
+    b = Mock(min=0, max=10, size=3, idle=2, qsize=0)
+    c = Mock(min=0, max=10, size=1, idle=1, qsize=0)
+    pool = ClassedPool([('a', a), ('b', b), ('c', c)])
+    pool.shrink(4, retire=RETIRE_OLDEST)
+    a.shrink.assert_called_once_with(1, retire=RETIRE_OLDEST)
+    b.shrink.assert_called_once_with(2, retire=RETIRE_OLDEST)
+    c.shrink.assert_called_once_with(1, retire=RETIRE_OLDEST)
+
+
+def test_thread_pool_runs_jobs_and_resizes():
+    pool = ThreadPool(min=2, max=10)
+    resizer = DynamicPoolResizer(pool, minspare=1, maxspare=3, shrinkfreq=0)
+    resizer.run()
+    assert (pool.size, pool.idle, pool.qsize) == (2, 2, 0)
+    release = threading.Event()
+    for _ in range(4):
+        pool.submit(release.wait, 2)
+    assert _wait_for(lambda: pool.idle == 0 and pool.qsize == 2)
+    resizer.run()
+    assert pool.size == 5
+    assert _wait_for(lambda: pool.idle == 1 and pool.qsize == 0)
+    release.set()
+    assert _wait_for(lambda: pool.idle == 5)
+    pool.shrink(3)
+    assert _wait_for(lambda: pool.size == 2)
+    pool.shutdown()
+    assert pool.size == 0
+
+
+def test_thread_pool_only_stops_idle_workers():
+    pool = ThreadPool(min=0)
+    pool.grow(3)
+    release = threading.Event()
+    pool.submit(release.wait, 2)
+    assert _wait_for(lambda: pool.idle == 2)
+    # Only the 2 idle workers can stop, and their stop signals aren't
+    # queued jobs.
+    pool.shrink(3)
+    assert pool.qsize == 0
+    assert _wait_for(lambda: pool.size == 1)
+    # The busy worker keeps serving the jobs queued meanwhile.
+    pool.submit(len, [])
+    pool.shrink(1)
+    assert pool.qsize == 1
+    release.set()
+    assert _wait_for(lambda: pool.idle == 1 and pool.qsize == 0)
+    assert pool.size == 1
+    pool.shutdown()
+    assert pool.size == 0
+
+
+def test_reference_pools_report_queue_waits():
+    pool = ThreadPool()
+    pool.submit(len, [])
+    time.sleep(0.05)
+    pool.grow(1)
+    assert _wait_for(lambda: pool.idle == 1)
+    waits = pool.waits()
+    assert len(waits) == 1 and waits[0] >= 0.05
+    assert pool.waits() == []
+    pool.shutdown()
+
+    resources = ResourcePool(object, min=0)
+    resources.grow(1)
+    resources.acquire()
+    assert resources.waits() == [0.0]
+
+
+def test_thread_pool_notifies_subscribers():
+    pool = ThreadPool()
+    callback = Mock()
+    pool.subscribe(callback)
+    pool.submit(len, [])
+    callback.assert_called_once_with(0, 1)
+    pool.unsubscribe(callback)
+    pool.submit(len, [])
+    assert callback.call_count == 1
+
+
+def test_thread_pool_logs_failed_jobs():
+    logger = Mock()
+    pool = ThreadPool(logger=logger)
+    pool.grow(1)
+    pool.submit(int, 'not a number')
+    assert _wait_for(lambda: logger.called)
+    pool.shutdown()
+    assert 'not a number' in logger.call_args[0][0]
+
+
+def test_resource_pool_reuses_warm_resources_and_closes_cold_ones():
+    created = itertools.count()
+    closed = []
+    pool = ResourcePool(lambda: next(created), close=closed.append, min=3)
+    DynamicPoolResizer(pool, minspare=1, maxspare=3).run()
+    assert (pool.size, pool.idle, pool.qsize) == (3, 3, 0)
+    first = pool.acquire()
+    assert first == 2
+    assert pool.idle == 2
+    pool.release(first)
+    pool.shrink(2)
+    assert closed == [0, 1]
+    assert (pool.size, pool.idle) == (1, 1)
+    assert pool.snapshot() == PoolSnapshot(1, 1, 0, 3, -1)
+
+
+def test_resource_pool_promotes_prewarmed_resources():
+    created = itertools.count()
+    pool = ResourcePool(lambda: next(created), min=0)
+    pool.prewarm(2)
+    assert (pool.size, pool.idle, pool.standby) == (0, 0, 2)
+    assert pool.promote(3) == 2
+    assert (pool.size, pool.idle, pool.standby) == (2, 2, 0)
+    assert pool.acquire() == 1
+
+
+def test_resource_pool_counts_are_consistent_under_concurrent_reads():
+    pool = ResourcePool(object, min=0)
+    pool.grow(2)
+    stop = threading.Event()
+    seen = []
+
+    def use():
+        while not stop.is_set():
+            pool.release(pool.acquire())
+
+    def read():
+        while not stop.is_set():
+            seen.append((pool.size, pool.qsize))
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    threads += [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert seen
+    assert all(size == 2 and 0 <= qsize <= 4 for size, qsize in seen)
+
+
+def test_resource_pool_counts_waiting_threads():
+    pool = ResourcePool(object, min=0)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    assert _wait_for(lambda: pool.qsize == 1)
+    pool.grow(1)
+    waiter.join(2)
+    assert len(acquired) == 1
+    assert (pool.size, pool.idle, pool.qsize) == (1, 0, 0)
+
+
+def test_process_pool():
+    pool = ProcessPool(min=1, max=2)
+    pool.grow(2)
+    assert (pool.size, pool.idle + pool.starting, pool.qsize) == (2, 2, 0)
+    assert _wait_for(lambda: pool.idle == 2)
+    assert pool.starting == 0
+    for _ in range(3):
+        pool.submit(time.sleep, 0.5)
+    assert _wait_for(lambda: pool.idle == 0 and pool.qsize == 1)
+    # No worker is idle, so there is nothing to stop.
+    pool.shrink(1)
+    assert pool.qsize == 1
+    assert _wait_for(lambda: pool.idle == 2 and pool.qsize == 0, 5)
+    pool.shrink(1)
+    assert pool.qsize == 0
+    assert _wait_for(lambda: pool.idle == 1 and pool.size == 1, 5)
+    pool.shutdown()
+    assert pool.size == 0
+
+
+def test_process_pool_needs_a_maximum():
+    with pytest.raises(ValueError):
+        ProcessPool(max=-1)
+
+
+def test_shared_stats_aggregates_published_slots():
+    stats = SharedStats(slots=4)
+    stats.publish(0, PoolSnapshot(5, 2, 0, 1, 10), now=100)
+    stats.publish(2, PoolSnapshot(3, 0, 4, 1, 10), now=100)
+    stats.publish(3, PoolSnapshot(9, 9, 0, 1, 10), now=50)
+    assert stats.read(1) is None
+    assert stats.read(0) == (os.getpid(), 100, PoolSnapshot(5, 2, 0, 1, 10))
+    # Slot 3 wasn't updated for longer than max_age.
+    assert stats.aggregate(now=101) == (PoolSnapshot(8, 2, 4, 2, 20), 2)
+
+    stats.publish(0, PoolSnapshot(5, 2, 0, 1, -1), now=100)
+    assert stats.aggregate(now=101)[0].max == -1
+    stats.release(0)
+    assert stats.read(0) is None
+    assert stats.aggregate(now=101) == (PoolSnapshot(3, 0, 4, 1, 10), 1)
+
+
+def test_shared_stats_skips_slots_left_in_the_middle_of_a_write():
+    stats = SharedStats(slots=2)
+    stats.publish(0, PoolSnapshot(5, 2, 0, 1, 10), now=100)
+    stats.publish(1, PoolSnapshot(3, 0, 4, 1, 10), now=100)
+    # The writer of slot 1 died after marking the write as started.
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    struct.pack_into('=Qq', stats.memory, SharedStats.SLOT.size, 3, dead.pid)
+    assert stats.read(1) is None
+    assert stats.aggregate(now=101) == (PoolSnapshot(5, 2, 0, 1, 10), 1)
+    stats.publish(1, PoolSnapshot(3, 0, 4, 1, 10), now=100)
+    assert stats.read(1)[2] == PoolSnapshot(3, 0, 4, 1, 10)
+    assert stats.aggregate(now=101)[1] == 2
+
+
+def test_shared_stats_keeps_the_last_value_of_slots_being_written():
+    stats = SharedStats(slots=2)
+    stats.publish(1, PoolSnapshot(3, 0, 4, 1, 10), now=100)
+    assert stats.read(1)[2] == PoolSnapshot(3, 0, 4, 1, 10)
+    # This process is alive, but its write takes too long.
+    struct.pack_into('=Q', stats.memory, SharedStats.SLOT.size, 3)
+    struct.pack_into('=q', stats.memory, SharedStats.SLOT.size + 24, 9)
+    assert stats.read(1)[2] == PoolSnapshot(3, 0, 4, 1, 10)
+    assert stats.aggregate(now=101)[1] == 1
+
+
+@pytest.mark.skipif(not hasattr(multiprocessing, 'get_context'),
+                    reason='needs multiprocessing.get_context()')
+def test_shared_stats_file_is_shared_between_processes(tmpdir):
+    path = str(tmpdir.join('stats'))
+    stats = SharedStats(slots=2, path=path)
+    context = multiprocessing.get_context('spawn')
+    child = context.Process(target=_publish_from_child, args=(stats, 1))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    assert stats.read(1)[2] == PoolSnapshot(4, 1, 3, 2, 10)
+
+
+def test_shared_stats_pool_resizes_from_the_aggregate():
+    stats = SharedStats(slots=2)
+    busy = Mock(size=4, idle=0, qsize=6, min=1, max=20)
+    quiet = Mock(size=4, idle=0, qsize=0, min=1, max=20)
+    busy_view = SharedStatsPool(busy, stats, 0)
+    quiet_view = SharedStatsPool(quiet, stats, 1)
+    busy_view.snapshot()
+    assert quiet_view.snapshot() == PoolSnapshot(8, 0, 6, 2, 40)
+
+    # Both processes see the same totals, and only the busy one grows.
+    DynamicPoolResizer(busy_view, minspare=2, maxspare=4).run()
+    DynamicPoolResizer(quiet_view, minspare=2, maxspare=4).run()
+    busy.grow.assert_called_once_with(8)
+    assert not quiet.grow.called
+
+    busy.qsize = 0
+    busy.idle = busy.size = 10
+    quiet.idle = 2
+    quiet_view.snapshot()
+    DynamicPoolResizer(busy_view, minspare=1, maxspare=2).run()
+    DynamicPoolResizer(quiet_view, minspare=1, maxspare=2).run()
+    # Shrink by 10 out of 12 idle resources, 10 of them in the first
+    # process. Shares are rounded up.
+    busy.shrink.assert_called_once_with(9)
+    quiet.shrink.assert_called_once_with(2)
+
+
+def test_resizer_passes_retire_hint():
+    pool = Mock()
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 retire=RETIRE_OLDEST)
+    resizer.shrink(2)
+    pool.shrink.assert_called_once_with(2, retire=RETIRE_OLDEST)
+
+
+def test_idle_tracker_select():
+    now = [0]
+    tracker = IdleTracker(measure=lambda resource: resource[1],
+                          clock=lambda: now[0])
+    old, big, used = ('old', 1), ('big', 100), ('used', 2)
+    for resource in (old, big, used):
+        tracker.add(resource)
+        now[0] += 1
+    for _ in range(3):
+        tracker.acquired(used)
+        tracker.released(used)
+    tracker.acquired(old)
+    tracker.released(old)
+    assert tracker.select(1) == [big]
+    assert tracker.select(1, RETIRE_OLDEST) == [old]
+    assert tracker.select(1, RETIRE_LARGEST) == [big]
+    assert tracker.select(1, RETIRE_MOST_USED) == [used]
+    tracker.acquired(big)
+    assert tracker.select(3) == [used, old]
+    assert tracker.select(3, candidates=[old]) == [old]
+    tracker.discard(used)
+    assert tracker.select(3, RETIRE_MOST_USED) == [old]
+
+
+def test_resource_pool_follows_retire_hint():
+    created = itertools.count()
+    closed = []
+    pool = ResourcePool(lambda: next(created), close=closed.append, min=3,
+                        tracker=IdleTracker())
+    pool.grow(3)
+    for _ in range(2):
+        pool.release(pool.acquire())
+    pool.shrink(1, retire=RETIRE_MOST_USED)
+    assert closed == [2]
+    pool.shrink(1)
+    assert closed == [2, 0]
+    assert (pool.size, pool.idle) == (1, 1)
+
+
+def test_maxgrow_limits_each_run():
+    pool = Mock(min=5, max=100, size=10, idle=0, qsize=50)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10, maxgrow=20)
+    resizer.run()
+    pool.grow.assert_called_once_with(20)
+    assert resizer.growdebt == 35
+
+
+def test_slowstart_doubles_and_resets():
+    pool = Mock(min=5, max=100, size=10, idle=0, qsize=50)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10, slowstart=2)
+    for _ in range(4):
+        resizer.run()
+    assert [args[0][0] for args in pool.grow.call_args_list] == [2, 4, 8, 16]
+    pool.idle, pool.qsize = 7, 0
+    resizer.run()
+    assert resizer.rampstep == 0
+    assert resizer.growdebt == 0
+    pool.idle, pool.qsize = 0, 50
+    resizer.run()
+    assert pool.grow.call_args[0][0] == 2
+
+
+def test_growrate_limits_resources_per_second():
+    now = [0.0]
+    pool = Mock(min=5, max=100, size=10, idle=0, qsize=50)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10, growrate=10,
+                                 clock=lambda: now[0])
+    resizer.run()
+    assert pool.grow.call_args[0][0] == 10
+    now[0] += 0.5
+    resizer.run()
+    assert pool.grow.call_args[0][0] == 5
+    resizer.run()
+    assert pool.grow.call_count == 2
+    now[0] += 10
+    resizer.run()
+    assert pool.grow.call_args[0][0] == 10
+
+
+def test_recorder_keeps_the_last_decisions():
+    recorder = DecisionRecorder(capacity=2)
+    pool = Mock(min=5, max=30, size=10, idle=2, qsize=0)
+    resizer = DynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                 clock=lambda: 7.5, recorder=recorder)
+    resizer.run()
+    pool.idle = 10
+    resizer.run()
+    pool.idle = 7
+    resizer.run()
+    assert len(recorder) == 2
+    assert list(recorder) == [
+        Decision(7.5, 10, 10, 0, 5, 30, 0, 5, -5),
+        Decision(7.5, 10, 7, 0, 5, 30, 0, 0, 0)]
+
+
+def test_recorder_dump_and_load(tmpdir):
+    recorder = DecisionRecorder()
+    recorder.record(1.25, PoolSnapshot(10, 0, 4, 5, -1), 9, 0, 9)
+    recorder.record(2.5, PoolSnapshot(19, 9, 0, 5, -1), 0, 2, -2)
+    path = str(tmpdir.join('decisions'))
+    with open(path, 'w') as dumped:
+        recorder.dump(dumped)
+    with open(path) as dumped:
+        assert DecisionRecorder.load(dumped) == list(recorder)
+
+
+def test_replay_with_other_settings():
+    decisions = [Decision(0, 10, 0, 4, 5, 30, 9, 0, 9),
+                 Decision(1, 19, 17, 0, 5, 30, 0, 6, -6)]
+    results = replay(decisions, lambda pool, clock: DynamicPoolResizer(
+        pool, minspare=2, maxspare=20, shrinkfreq=0, clock=clock))
+    assert [delta for _, delta in results] == [6, 0]
+
+
+def test_replay_command(tmpdir, capsys):
+    trace = tmpdir.join('decisions.txt')
+    trace.write(DecisionRecorder.HEADER + '\n0.0 10 0 4 5 30 9 0 9\n')
+    main(['replay', str(trace), '--minspare', '2', '--maxspare', '20'])
+    out = capsys.readouterr()[0]
+    assert 'recorded=+9 replayed=+6 *' in out
+    assert '1 of 1 decisions changed' in out
@@ -0,0 +1,106 @@
+import asyncio
+
+from mock import Mock
+
+from dynpool_asyncio import AsyncDynamicPoolResizer
+from stubs import StubPool
+
+
+class AsyncPool(StubPool):
+    async def grow(self, amount):
+        await asyncio.sleep(0)
+        self.grown.append(amount)
+
+    async def shrink(self, amount):
+        await asyncio.sleep(0)
+        self.shrunk.append(amount)
+
+
+def test_run_awaits_pool_grow():
+    pool = AsyncPool(min=5, max=30, size=0, idle=0, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10)
+    asyncio.run(resizer.run())
+    assert pool.grown == [5]
+    assert pool.shrunk == []
+
+
+def test_run_awaits_pool_shrink():
+    pool = AsyncPool(min=5, max=30, size=10, idle=10, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10)
+    asyncio.run(resizer.run())
+    assert pool.grown == []
+    assert pool.shrunk == [5]
+    assert resizer.lastshrink is not None
+
+
+def test_run_accepts_synchronous_pool_methods():
+    pool = Mock(min=5, max=30, size=0, idle=0, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10)
+    asyncio.run(resizer.run())
+    pool.grow.assert_called_once_with(5)
+
+
+def test_background_task_runs_and_wakes_up():
+    pool = AsyncPool(min=0, max=30, size=5, idle=5, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10)
+
+    async def scenario():
+        resizer.start(interval=60)
+        await asyncio.sleep(0.01)
+        assert resizer.running
+        pool.idle = 0
+        pool.qsize = 3
+        resizer.wakeup()
+        await asyncio.sleep(0.01)
+        await resizer.stop()
+
+    asyncio.run(scenario())
+    assert pool.grown == [8]
+    assert not resizer.running
+
+
+def test_run_promotes_and_prewarms():
+    class WarmingPool(AsyncPool):
+        standby = 0
+
+        def promote(self, amount):
+            promoted = min(amount, self.standby)
+            self.standby -= promoted
+            return promoted
+
+        async def prewarm(self, amount):
+            self.standby += amount
+
+    pool = WarmingPool(min=5, max=30, size=0, idle=0, qsize=0, standby=2)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                      reserve=4)
+    asyncio.run(resizer.run())
+    assert pool.grown == [3]
+    assert pool.standby == 4
+
+
+def test_contended_runs_work_in_a_loop_started_after_the_resizer():
+    pool = AsyncPool(min=5, max=30, size=0, idle=0, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10)
+
+    async def scenario():
+        return await asyncio.gather(resizer.run(), resizer.run())
+
+    assert asyncio.run(scenario()) == [True, True]
+    assert pool.grown == [5, 5]
+
+
+def test_mininterval_skips_concurrent_and_recent_runs():
+    pool = AsyncPool(min=5, max=30, size=0, idle=0, qsize=0)
+    resizer = AsyncDynamicPoolResizer(pool, minspare=5, maxspare=10,
+                                      mininterval=60)
+
+    async def scenario():
+        first = await asyncio.gather(resizer.run(), resizer.run())
+        return first + [await resizer.run()]
+
+    assert asyncio.run(scenario()) == [True, False, False]
+    assert pool.grown == [5]
+    resizer.mininterval = 0
+    assert asyncio.run(resizer.run()) is True
+    assert pool.grown == [5, 5]